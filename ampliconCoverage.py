@@ -0,0 +1,108 @@
+from commandLineArgsDeclaration import CommandLineArgs
+from iohts import ReadBatch
+from typing import Tuple
+
+import numpy as np
+
+def fragment_ends_of_read_batch(batch: ReadBatch) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Return the leftmost and rightmost (exclusive) ends of the fragments in a batch, one per fragment.
+
+    The fragment of a read pair is counted by its read with a positive tlen. An unpaired read (or a
+    read with a zero tlen) is its own fragment, the same as get_fragment_tidpos_pairs.
+    """
+    is_fragment = batch.tlen >= 0
+    begs = batch.ref_start[is_fragment]
+    ends = np.where(batch.tlen[is_fragment] > 0, begs + batch.tlen[is_fragment], batch.ref_end[is_fragment])
+    return begs, ends
+
+class AmpliconCoverage:
+    """
+    Fragment start, fragment end and insert coverage of one region, with their prefix sums.
+
+    All three count arrays are built in one pass over the fragments: the starts and ends with
+    bincount, and the insert coverage as the cumulative sum of a difference array. The prefix sums
+    make the total of any of them over any window an O(1) lookup, so every border-to-insert ratio
+    of the dedup_amplicon_* heuristics is computed for all positions at once.
+    Array indexes are positions relative to beg_pos, and fragments are clipped to [beg_pos, end_pos).
+    """
+    def __init__(self, beg_pos: int, end_pos: int, frag_begs: np.ndarray, frag_ends: np.ndarray):
+        self.beg_pos = beg_pos
+        self.end_pos = end_pos
+        region_len = end_pos - beg_pos
+        is_in_region = (frag_ends > beg_pos) & (frag_begs < end_pos)
+        self.frag_begs = np.clip(frag_begs[is_in_region], beg_pos, end_pos) - beg_pos
+        self.frag_ends = np.clip(frag_ends[is_in_region], beg_pos, end_pos) - beg_pos
+        # Fragments starting before or ending after the region have no border inside it.
+        self.is_beg_inside = frag_begs[is_in_region] >= beg_pos
+        self.is_end_inside = frag_ends[is_in_region] <= end_pos
+        self.start_counts = np.bincount(self.frag_begs[self.is_beg_inside], minlength=region_len)
+        self.end_counts = np.bincount(self.frag_ends[self.is_end_inside] - 1, minlength=region_len)
+        diff = np.bincount(self.frag_begs, minlength=region_len + 1) - np.bincount(self.frag_ends, minlength=region_len + 1)
+        self.insert_cov = np.cumsum(diff[:-1])
+        self.start_prefix_sums = np.concatenate(([0], np.cumsum(self.start_counts)))
+        self.end_prefix_sums = np.concatenate(([0], np.cumsum(self.end_counts)))
+        self.insert_cov_prefix_sums = np.concatenate(([0], np.cumsum(self.insert_cov)))
+        self.n_covered_prefix_sums = np.concatenate(([0], np.cumsum(self.insert_cov > 0)))
+
+    @classmethod
+    def from_read_batch(cls, batch: ReadBatch, beg_pos: int, end_pos: int) -> 'AmpliconCoverage':
+        return cls(beg_pos, end_pos, *fragment_ends_of_read_batch(batch))
+
+    def n_starts(self, beg: int, end: int) -> int:
+        return int(self.start_prefix_sums[end - self.beg_pos] - self.start_prefix_sums[beg - self.beg_pos])
+
+    def n_ends(self, beg: int, end: int) -> int:
+        return int(self.end_prefix_sums[end - self.beg_pos] - self.end_prefix_sums[beg - self.beg_pos])
+
+    def avg_insert_cov(self, beg: int, end: int) -> float:
+        if end <= beg:
+            return 0.0
+        return float(self.insert_cov_prefix_sums[end - self.beg_pos] - self.insert_cov_prefix_sums[beg - self.beg_pos]) / (end - beg)
+
+    def n_covered(self, beg: int, end: int) -> int:
+        return int(self.n_covered_prefix_sums[end - self.beg_pos] - self.n_covered_prefix_sums[beg - self.beg_pos])
+
+    def border_masks(self, border_counts: np.ndarray, args: CommandLineArgs) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return which positions are weak and strong amplicon borders given their start (or end) counts.
+
+        A position is a border if its count is at least dedup_amplicon_border_*_minDP, at least
+        dedup_amplicon_border_to_insert_cov_*_avgDP_ratio times the average count per position
+        covered by inserts, and at least dedup_amplicon_border_to_insert_cov_*_totDP_ratio times the
+        insert coverage at the position.
+        """
+        avg_count = float(border_counts.sum()) / max(1, self.n_covered(self.beg_pos, self.end_pos))
+        is_weak = ((border_counts >= args.dedup_amplicon_border_weak_minDP)
+                   & (border_counts >= args.dedup_amplicon_border_to_insert_cov_weak_avgDP_ratio * avg_count)
+                   & (border_counts >= args.dedup_amplicon_border_to_insert_cov_weak_totDP_ratio * self.insert_cov))
+        is_strong = ((border_counts >= args.dedup_amplicon_border_strong_minDP)
+                     & (border_counts >= args.dedup_amplicon_border_to_insert_cov_strong_avgDP_ratio * avg_count)
+                     & (border_counts >= args.dedup_amplicon_border_to_insert_cov_strong_totDP_ratio * self.insert_cov))
+        return is_weak, is_strong
+
+    def amplicon_fragment_mask(self, args: CommandLineArgs) -> np.ndarray:
+        """Return which fragments (in the order of the fragments in the region) start and end at weak borders."""
+        is_weak_start, _ = self.border_masks(self.start_counts, args)
+        is_weak_end, _ = self.border_masks(self.end_counts, args)
+        region_len = self.end_pos - self.beg_pos
+        is_start_border = self.is_beg_inside & is_weak_start[np.minimum(self.frag_begs, region_len - 1)]
+        is_end_border = self.is_end_inside & is_weak_end[np.maximum(self.frag_ends - 1, 0)]
+        return is_start_border & is_end_border
+
+    def is_amplicon(self, args: CommandLineArgs) -> bool:
+        """
+        Return whether the fragments of the region are amplicons.
+
+        The region is amplicon if it has a strong start border and a strong end border, or if the
+        number of fragments is at most dedup_amplicon_end2end_ratio times the number of fragments
+        starting and ending at weak borders.
+        """
+        n_frags = len(self.frag_begs)
+        if n_frags == 0:
+            return False
+        _, is_strong_start = self.border_masks(self.start_counts, args)
+        _, is_strong_end = self.border_masks(self.end_counts, args)
+        if is_strong_start.any() and is_strong_end.any():
+            return True
+        return n_frags <= args.dedup_amplicon_end2end_ratio * int(self.amplicon_fragment_mask(args).sum())
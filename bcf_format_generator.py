@@ -553,6 +553,97 @@ def vcf_number_to_header_str(number):
     elif number == 'R':
         return 'R'
     return '.'  # Default case
+
+def generate_stream_append_bcf_format(format_vec=None):
+    """Return the lines of streamAppendBcfFormat, which appends the FORMAT fields one by one with +=."""
+    output = ["def streamAppendBcfFormat(outstring, fmt):"]
+    itnum = 0
+    for fmt in (FORMAT_VEC if format_vec is None else format_vec):
+        if fmt['is_not_in_out_vcf']:
+            output.append(f"    # The FORMAT/TAG {fmt['id']} is skipped")
+            itnum += 1
+            continue
+        addcheck = f"if fmt.enable_tier2_consensus_format_tags" if fmt['is_SSCS_required'] else "if True"
+        output.append(f"    {addcheck}:")
+        if itnum:
+            output.append("        outstring += \":\"")
+        if fmt['type'] == 'SEP':
+            output.append(f"        outstring += FORMAT_IDS[{itnum}] + \"\"")
+        else:
+            output.append(f"        outstring += str(fmt.{fmt['id']})")
+        output.append("")
+        itnum += 1
+    output.append("    return 0")
+    return output
+
+def _join_serializer_fields(format_vec, is_SSCS_enabled):
+    # The (itnum, expression) of each field written by streamAppendBcfFormat for the given SSCS setting.
+    fields = []
+    for itnum, fmt in enumerate(format_vec):
+        if fmt['is_not_in_out_vcf'] or (fmt['is_SSCS_required'] and not is_SSCS_enabled):
+            continue
+        fields.append((itnum, f"\"{fmt['id']}\"" if fmt['type'] == 'SEP' else f"str(fmt.{fmt['id']})"))
+    return fields
+
+def generate_join_bcf_format_serializers(format_vec=None):
+    """
+    Return the lines of formatBcfFormat and its two specialized variants (with and without the SSCS tags).
+
+    Each variant builds all of its fields in one tuple and joins them once, without any per-tag check.
+    The output is the same as what streamAppendBcfFormat appends, including the leading separator
+    when the first FORMAT tag is not written.
+    """
+    output = []
+    for func_name, is_SSCS_enabled in (("formatBcfFormatWithSSCS", True), ("formatBcfFormatWithoutSSCS", False)):
+        fields = _join_serializer_fields((FORMAT_VEC if format_vec is None else format_vec), is_SSCS_enabled)
+        prefix = "\":\" + " if fields and fields[0][0] > 0 else ""
+        output.append(f"def {func_name}(fmt):")
+        if not fields:
+            output.append("    return \"\"")
+            continue
+        output.append(f"    return {prefix}\":\".join((")
+        for _, expr in fields:
+            output.append(f"        {expr},")
+        output.append("    ))")
+    output.append("def formatBcfFormat(fmt):")
+    output.append("    if fmt.enable_tier2_consensus_format_tags:")
+    output.append("        return formatBcfFormatWithSSCS(fmt)")
+    output.append("    return formatBcfFormatWithoutSSCS(fmt)")
+    return output
+
+def benchmark_bcf_format_serializers(n_records=20000, n_tags=200):
+    """
+    Compare the records per second of streamAppendBcfFormat and of formatBcfFormat on the same records.
+
+    Besides FORMAT_VEC, the FORMAT tags are also repeated up to n_tags tags (with every third one
+    requiring SSCS) to match the size of a full FORMAT_VEC. The emitted legacy function returns 0,
+    so a copy returning its string is used to check that both give the same output.
+    """
+    import time
+    import types
+    repeated_format_vec = [dict(FORMAT_VEC[itnum % len(FORMAT_VEC)], id=f"{FORMAT_VEC[itnum % len(FORMAT_VEC)]['id']}{itnum}",
+                                is_SSCS_required=(itnum % 3 == 2)) for itnum in range(n_tags)]
+    lines = ["n_tags\tenable_tier2_consensus_format_tags\tlegacy_records_per_sec\tjoin_records_per_sec\tspeedup\tis_same_output"]
+    for format_vec in (FORMAT_VEC, repeated_format_vec):
+        legacy_code = "\n".join(generate_stream_append_bcf_format(format_vec)).replace("    return 0", "    return outstring")
+        namespace = {"FORMAT_IDS": [fmt['id'] for fmt in format_vec]}
+        exec(legacy_code, namespace)
+        exec("\n".join(generate_join_bcf_format_serializers(format_vec)), namespace)
+        fmt = types.SimpleNamespace(enable_tier2_consensus_format_tags=False)
+        for itnum, fmt_struct in enumerate(format_vec):
+            setattr(fmt, fmt_struct['id'], [itnum, itnum + 1] if fmt_struct['in_num_1'] != 1 else itnum)
+        for is_SSCS_enabled in (False, True):
+            fmt.enable_tier2_consensus_format_tags = is_SSCS_enabled
+            is_same_output = namespace["streamAppendBcfFormat"]("", fmt) == namespace["formatBcfFormat"](fmt)
+            rates = []
+            for func in (lambda: namespace["streamAppendBcfFormat"]("", fmt), lambda: namespace["formatBcfFormat"](fmt)):
+                beg_time = time.perf_counter()
+                for _ in range(n_records):
+                    func()
+                rates.append(n_records / max(time.perf_counter() - beg_time, 1e-9))
+            lines.append(f"{len(format_vec)}\t{is_SSCS_enabled}\t{rates[0]:.0f}\t{rates[1]:.0f}\t{rates[1] / rates[0]:.3f}\t{is_same_output}")
+    return "\n".join(lines)
+
 def generate_bcf_formats():
     itnum = 0
     output = []
@@ -651,24 +742,11 @@ def generate_bcf_formats():
     output.append("")
 
     # Python equivalent of streamAppendBcfFormat
-    output.append("def streamAppendBcfFormat(outstring, fmt):")
-    itnum = 0
-    for fmt in FORMAT_VEC:
-        if fmt['is_not_in_out_vcf']:
-            output.append(f"    # The FORMAT/TAG {fmt['id']} is skipped")
-            itnum += 1
-            continue
-        addcheck = f"if fmt.enable_tier2_consensus_format_tags" if fmt['is_SSCS_required'] else "if True"
-        output.append(f"    {addcheck}:")
-        if itnum:
-            output.append("        outstring += \":\"")
-        if fmt['type'] == 'SEP':
-            output.append(f"        outstring += FORMAT_IDS[{itnum}] + \"\"")
-        else:
-            output.append(f"        outstring += str(fmt.{fmt['id']})")
-        output.append("")
-        itnum += 1
-    output.append("    return 0")
+    output.extend(generate_stream_append_bcf_format())
+
+    # Specialized serializers that join the pre-formatted fields once instead of using +=
+    output.extend(generate_join_bcf_format_serializers())
+    output.append("")
 
     # Python equivalent of resetBcfFormatD
     output.append("def resetBcfFormatD(fmt):")
@@ -716,6 +794,9 @@ def generate_bcf_formats():
     # Return joined output as a string
     return "\n".join(output)
 
-# Output the generated file content
-print(generate_bcf_formats())
-print("Program run successfully.")
+# Output the generated file content, or with --benchmark, the records per second of the two FORMAT serializers
+if "--benchmark" in sys.argv[1:]:
+    print(benchmark_bcf_format_serializers())
+else:
+    print(generate_bcf_formats())
+    print("Program run successfully.")
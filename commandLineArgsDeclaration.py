@@ -52,6 +52,7 @@ class CommandLineArgs:
         self.kept_aln_min_isize = 0
         self.kept_aln_max_isize = sys.maxsize
         self.kept_aln_is_zero_isize_discarded = False
+        self.kept_aln_discarded_flag = 0xB04  # unmapped (0x4) + secondary (0x100) + QC-fail (0x200) + supplementary (0x800)
         self.min_altdp_thres = 2
         self.vdp1 = 1000
         self.vad1 = 4
@@ -121,6 +122,8 @@ class CommandLineArgs:
         self.fam_bias_overseq_perc = 150
         self.fam_tier3DP_bias_overseq_perc = 350
         self.fam_indel_nonUMI_phred_dec_per_fold_overseq = 9
+        self.fam_umi_cluster_mode = "none"  # none, adjacency or directional
+        self.fam_umi_cluster_max_dist = 1
         
         # *** 08. parameters related to systematic errors
         self.syserr_BQ_prior = 30
@@ -251,6 +251,11 @@ def main():
         type=int, choices=[0, 1], 
         help="Indicates if an alignment with zero insert size should be filtered out."
     )
+    parser.add_argument(
+        "--kept-aln-discarded-flag", 
+        type=lambda x: int(x, 0), 
+        help="Alignment filtered out if its SAM flag shares any bit with this flag (for example, 0x400 to discard duplicates)."
+    )
 
     parser.add_argument(
         "--min-altdp-thres", 
@@ -329,6 +334,16 @@ def main():
         action="store_true", 
         help="Flag indicating if duplex reads should not be merged into double-strand consensus sequences."
     )
+    parser.add_argument(
+        "--fam-umi-cluster-mode", 
+        type=str, choices=["none", "adjacency", "directional"], 
+        help="Mode for merging the UMI families at the same position whose UMIs differ by sequencing errors."
+    )
+    parser.add_argument(
+        "--fam-umi-cluster-max-dist", 
+        type=int, 
+        help="Maximum Hamming distance between two UMIs that can be merged by --fam-umi-cluster-mode."
+    )
 
     
  
@@ -0,0 +1,208 @@
+from commandLineArgsDeclaration import CommandLineArgs, FASTQ_LIKE_SUFFIXES, NUM_FQLIKE_CON_OUT_FILES
+from iohts import ParallelBgzfWriter, ReadBatch
+from collections import namedtuple
+from typing import List, Tuple
+
+import numpy as np
+
+# Symbols of a consensus column. SYMBOL_NONE is a column not covered by the read (or without consensus).
+SYMBOL_A, SYMBOL_C, SYMBOL_G, SYMBOL_T, SYMBOL_N, SYMBOL_GAP, SYMBOL_NONE = range(7)
+N_COUNTED_SYMBOLS = 6
+SYMBOL_TO_CHAR = np.frombuffer(b"ACGTN- ", dtype=np.uint8)
+BASE_TO_SYMBOL = np.full(256, SYMBOL_N, dtype=np.uint8)
+for _symbol, _base in enumerate("ACGT"):
+    BASE_TO_SYMBOL[ord(_base)] = _symbol
+    BASE_TO_SYMBOL[ord(_base.lower())] = _symbol
+CONSENSUS_MAX_BQ = 93  # The highest base quality printable in FASTQ
+
+BAM_CMATCH, BAM_CINS, BAM_CDEL, BAM_CREF_SKIP, BAM_CSOFT_CLIP, BAM_CHARD_CLIP, BAM_CPAD, BAM_CEQUAL, BAM_CDIFF = range(9)
+
+FamilyConsensus = namedtuple('FamilyConsensus', [
+    'col_begs', 'family_offsets', 'depths',
+    'tier1_symbols', 'tier1_quals', 'tier1_counts', 'tier1_depths',
+    'tier2_symbols', 'tier2_quals', 'tier2_counts'])
+
+def stack_family_reads(
+    batch: ReadBatch,
+    family_ids: np.ndarray,
+    n_families: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack the reads of many families into flat symbol and quality arrays with one entry per read column.
+
+    The columns of family f are [family_offsets[f], family_offsets[f + 1]) of the flat column
+    space, and column family_offsets[f] + j is the reference position col_begs[f] + j, where
+    col_begs[f] is the leftmost position of the reads of family f. Each family spans only its own
+    reads, so the size of the column space is the sum of the family spans, not n_families times the
+    largest span. The entries of read i are at [read_offsets[i], read_offsets[i + 1]), one per
+    reference position of the read, and cols holds the flat column of every entry. Aligned bases
+    become their symbols, and deleted reference positions become SYMBOL_GAP with the lower quality
+    of the two flanking bases. Insertions and clipped bases have no reference column and are
+    skipped. Missing base qualities (0xFF) are taken as zero. Reads without bases (SEQ '*') are left
+    as SYMBOL_NONE.
+
+    :return: The symbols, the qualities, cols, read_offsets, col_begs and family_offsets.
+    """
+    n_reads = len(batch)
+    col_begs = np.full(n_families, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(col_begs, family_ids, batch.ref_start)
+    col_begs[col_begs == np.iinfo(np.int64).max] = 0
+    col_ends = col_begs.copy()
+    np.maximum.at(col_ends, family_ids, batch.ref_end)
+    family_offsets = np.concatenate(([0], np.cumsum(col_ends - col_begs)))
+    read_spans = (batch.ref_end - batch.ref_start).astype(np.int64)
+    read_offsets = np.concatenate(([0], np.cumsum(read_spans)))
+    n_entries = int(read_offsets[-1])
+    read_cols = family_offsets[family_ids] + batch.ref_start - col_begs[family_ids]
+    cols = np.repeat(read_cols - read_offsets[:-1], read_spans) + np.arange(n_entries)
+    symbols = np.full(n_entries, SYMBOL_NONE, dtype=np.uint8)
+    quals = np.zeros(n_entries, dtype=np.uint8)
+    seq_symbols = BASE_TO_SYMBOL[batch.seq]
+    seq_quals = np.where(batch.qual == 0xFF, 0, batch.qual).astype(np.uint8)
+    for i in range(n_reads):
+        pos = int(read_offsets[i])
+        qpos = int(batch.seq_offsets[i])
+        qend = int(batch.seq_offsets[i + 1])
+        if qend == qpos:
+            continue
+        for op, oplen in batch.cigartuples_of(i):
+            if op in (BAM_CMATCH, BAM_CEQUAL, BAM_CDIFF):
+                symbols[pos:pos + oplen] = seq_symbols[qpos:qpos + oplen]
+                quals[pos:pos + oplen] = seq_quals[qpos:qpos + oplen]
+                pos += oplen
+                qpos += oplen
+            elif op in (BAM_CINS, BAM_CSOFT_CLIP):
+                qpos += oplen
+            elif op == BAM_CDEL:
+                flank_quals = [seq_quals[qp] for qp in (qpos - 1, qpos) if int(batch.seq_offsets[i]) <= qp < qend]
+                symbols[pos:pos + oplen] = SYMBOL_GAP
+                quals[pos:pos + oplen] = min(flank_quals) if flank_quals else 0
+                pos += oplen
+            elif op == BAM_CREF_SKIP:
+                pos += oplen
+    return symbols, quals, cols, read_offsets, col_begs, family_offsets
+
+def _call_tier(
+    bins: np.ndarray,
+    quals: np.ndarray,
+    is_counted: np.ndarray,
+    n_cols: int,
+    thres_add: int,
+    thres_perc: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # One bincount over (flat column, symbol) for all the reads of all the families.
+    n_bins = n_cols * N_COUNTED_SYMBOLS
+    counted_bins = bins[is_counted]
+    counts = np.bincount(counted_bins, minlength=n_bins).reshape(n_cols, N_COUNTED_SYMBOLS)
+    qual_sums = np.bincount(counted_bins, weights=quals[is_counted], minlength=n_bins).astype(np.int64).reshape(counts.shape)
+    depths = counts.sum(axis=1)
+    con_symbols = counts.argmax(axis=1)
+    con_counts = np.take_along_axis(counts, con_symbols[:, None], axis=1)[:, 0]
+    # The consensus quality is the quality sum of the supporting bases minus that of the other bases.
+    con_qual_sums = np.take_along_axis(qual_sums, con_symbols[:, None], axis=1)[:, 0]
+    con_quals = np.clip(2 * con_qual_sums - qual_sums.sum(axis=1), 0, CONSENSUS_MAX_BQ)
+    is_passed = (con_counts >= thres_add) & (con_counts * 100 >= thres_perc * depths) & (depths > 0)
+    return (np.where(is_passed, con_symbols, SYMBOL_NONE).astype(np.uint8),
+            np.where(is_passed, con_quals, 0).astype(np.uint8),
+            con_counts, depths)
+
+def build_family_consensus(
+    symbols: np.ndarray,
+    quals: np.ndarray,
+    cols: np.ndarray,
+    read_offsets: np.ndarray,
+    col_begs: np.ndarray,
+    family_offsets: np.ndarray,
+    args: CommandLineArgs,
+    query_lens: np.ndarray = None
+) -> FamilyConsensus:
+    """
+    Compute the tier-1 and tier-2 consensus of every column of every family at once.
+
+    The inputs are the flat arrays of stack_family_reads, and every output array has one value per
+    flat column, so the consensus of family f is at [family_offsets[f], family_offsets[f + 1]).
+    Tier 1 counts only the high-quality symbols, which are bases with a quality of at least
+    fam_thres_highBQ_snv and gaps with a quality of at least fam_thres_highBQ_indel. Tier 2 counts
+    all symbols. A tier has a consensus at a column if its most common symbol is supported by at
+    least fam_thres_dup{1,2}add reads and fam_thres_dup{1,2}perc percent of the counted reads, and
+    otherwise its symbol is SYMBOL_NONE. Reads shorter than fam_thres_qseqlen are not counted if
+    query_lens is given.
+    """
+    n_cols = int(family_offsets[-1])
+    is_covered = symbols < N_COUNTED_SYMBOLS
+    if query_lens is not None:
+        is_covered &= np.repeat(query_lens >= args.fam_thres_qseqlen, np.diff(read_offsets))
+    bins = cols * N_COUNTED_SYMBOLS + np.minimum(symbols, N_COUNTED_SYMBOLS - 1)
+    high_bq_thres = np.where(symbols == SYMBOL_GAP, args.fam_thres_highBQ_indel, args.fam_thres_highBQ_snv)
+    tier1_symbols, tier1_quals, tier1_counts, tier1_depths = _call_tier(
+        bins, quals, is_covered & (quals >= high_bq_thres), n_cols,
+        args.fam_thres_dup1add, args.fam_thres_dup1perc)
+    tier2_symbols, tier2_quals, tier2_counts, depths = _call_tier(
+        bins, quals, is_covered, n_cols,
+        args.fam_thres_dup2add, args.fam_thres_dup2perc)
+    return FamilyConsensus(col_begs, family_offsets, depths, tier1_symbols, tier1_quals, tier1_counts, tier1_depths,
+                           tier2_symbols, tier2_quals, tier2_counts)
+
+def build_read_batch_consensus(batch: ReadBatch, family_ids: np.ndarray, n_families: int, args: CommandLineArgs) -> FamilyConsensus:
+    """Stack the reads of a batch by family and compute the consensus of all the families in one call."""
+    symbols, quals, cols, read_offsets, col_begs, family_offsets = stack_family_reads(batch, family_ids, n_families)
+    return build_family_consensus(symbols, quals, cols, read_offsets, col_begs, family_offsets, args, batch.query_len())
+
+def consensus_to_strings(con_symbols: np.ndarray, con_quals: np.ndarray, depths: np.ndarray) -> Tuple[str, str]:
+    """
+    Return the consensus sequence and its FASTQ quality string for one family.
+
+    The arguments are the columns of the family, [family_offsets[f], family_offsets[f + 1]) of the
+    FamilyConsensus arrays. Gaps and columns not covered by any read are removed, and the other
+    columns without consensus become N with the lowest quality.
+    """
+    is_kept = (con_symbols != SYMBOL_GAP) & (depths > 0)
+    chars = SYMBOL_TO_CHAR[np.where(con_symbols == SYMBOL_NONE, SYMBOL_N, con_symbols)[is_kept]]
+    return chars.tobytes().decode(), (con_quals[is_kept] + 33).astype(np.uint8).tobytes().decode()
+
+FASTQ_R1_IDX, FASTQ_R2_IDX, FASTQ_SE_IDX = range(NUM_FQLIKE_CON_OUT_FILES)
+
+class ConsensusFastqWriter:
+    """
+    Writer of the consensus FASTQ files (R1, R2 and SE) named by the --fam-consensus-out-fastq prefix.
+
+    A consensus is written only if its family has at least fam_consensus_out_fastq_thres_dup1add
+    reads, so filtered records are never formatted or compressed.
+    """
+    def __init__(self, args: CommandLineArgs, n_threads: int = 1):
+        self.min_family_size = args.fam_consensus_out_fastq_thres_dup1add
+        self.writers = [ParallelBgzfWriter(args.fam_consensus_out_fastq + suffix, n_threads) for suffix in FASTQ_LIKE_SUFFIXES]
+        self.n_written = [0] * NUM_FQLIKE_CON_OUT_FILES
+        self.n_filtered = 0
+
+    def _write(self, file_idx: int, name: str, seq: str, qual: str) -> None:
+        self.writers[file_idx].write(f"@{name}\n{seq}\n+\n{qual}\n".encode())
+        self.n_written[file_idx] += 1
+
+    def write_pair(self, name: str, family_size: int, r1_seq: str, r1_qual: str, r2_seq: str, r2_qual: str) -> bool:
+        if family_size < self.min_family_size:
+            self.n_filtered += 1
+            return False
+        self._write(FASTQ_R1_IDX, name, r1_seq, r1_qual)
+        self._write(FASTQ_R2_IDX, name, r2_seq, r2_qual)
+        return True
+
+    def write_single(self, name: str, family_size: int, seq: str, qual: str) -> bool:
+        if family_size < self.min_family_size:
+            self.n_filtered += 1
+            return False
+        self._write(FASTQ_SE_IDX, name, seq, qual)
+        return True
+
+    def close(self) -> None:
+        for writer in self.writers:
+            writer.close()
+
+    def format_stats(self) -> List[str]:
+        return [f"{writer.fname}\tn_records={n_written}\t{writer.stats}" for writer, n_written in zip(self.writers, self.n_written)]
+
+    def __enter__(self) -> 'ConsensusFastqWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,225 @@
+from commonClasses import MAX_INSERT_SIZE, uvc1_flag_t, uvc1_refgpos_t
+from molecularID import DEFAULT_DEDUP_IDFLAG, DUPLEX_UMI_SEP, molecular_barcode_from_alignment
+from molecularIDDeclaration import MolecularBarcode
+from umiClustering import UMI_CLUSTER_MODE_NONE, UmiClusteringStats, cluster_umis
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+class ReadFamily:
+    __slots__ = ("key", "tid", "leftmost_pos", "alns")
+
+    def __init__(self, key: MolecularBarcode, tid: int, leftmost_pos: uvc1_refgpos_t):
+        self.key = key
+        self.tid = tid
+        self.leftmost_pos = leftmost_pos
+        self.alns = []
+
+class FamilyGroupingStats:
+    def __init__(self):
+        self.n_reads = 0
+        self.n_skipped_reads = 0
+        self.n_flushed_families = 0
+        self.n_open_families = 0
+        self.n_open_reads = 0
+        self.peak_open_families = 0
+        self.peak_open_reads = 0
+
+    def __str__(self) -> str:
+        return (f"FamilyGroupingStats(n_reads={self.n_reads} n_skipped_reads={self.n_skipped_reads} "
+                f"n_flushed_families={self.n_flushed_families} n_open_families={self.n_open_families} "
+                f"peak_open_families={self.peak_open_families} peak_open_reads={self.peak_open_reads})")
+
+class StreamingFamilyGrouper:
+    """
+    Group coordinate-sorted reads into families keyed by the createKey() projection of their molecular barcodes.
+
+    Open families are kept in a dict keyed by barcode. Because the reads are coordinate-sorted,
+    families are created in the order of their leftmost positions, so they are also kept in a
+    queue in that order. Once the read cursor is more than max_insert_size past the leftmost
+    position of a family, no more reads of that fragment can come, so the family is flushed.
+    Memory is therefore bounded by the reads within max_insert_size of the cursor.
+
+    If umi_cluster_mode is not UMI_CLUSTER_MODE_NONE, the flushed families that differ only by their
+    UMI are merged when their UMIs are clustered together (see umiClustering.cluster_umis). Families
+    with the same fragment ends have the same leftmost position, so they are flushed together.
+    """
+    def __init__(
+        self,
+        dedup_idflag: uvc1_flag_t = DEFAULT_DEDUP_IDFLAG,
+        max_insert_size: int = MAX_INSERT_SIZE,
+        umi_cluster_mode: str = UMI_CLUSTER_MODE_NONE,
+        umi_cluster_max_dist: int = 1
+    ):
+        self.dedup_idflag = dedup_idflag
+        self.max_insert_size = max_insert_size
+        self.umi_cluster_mode = umi_cluster_mode
+        self.umi_cluster_max_dist = umi_cluster_max_dist
+        self.open_families: Dict[MolecularBarcode, ReadFamily] = {}
+        self.open_family_queue = deque()
+        self.stats = FamilyGroupingStats()
+        self.umi_clustering_stats = UmiClusteringStats()
+
+    def _merge_by_umi_clusters(self, families: List[ReadFamily]) -> List[ReadFamily]:
+        position_to_families = {}
+        for family in families:
+            beg_tidpos_pair, end_tidpos_pair, qnamestring, _, duplexflag, dedup_idflag = family.key.createKeyTuple()
+            position_to_families.setdefault((beg_tidpos_pair, end_tidpos_pair, qnamestring, duplexflag, dedup_idflag), []).append(family)
+        merged_away = set()
+        for position_families in position_to_families.values():
+            if len(position_families) < 2:
+                continue
+            umi_to_family = {family.key.umistring: family for family in position_families}
+            umi_to_representative = cluster_umis({umi: len(family.alns) for umi, family in umi_to_family.items()},
+                                                 self.umi_cluster_mode, self.umi_cluster_max_dist, self.umi_clustering_stats)
+            for umi, representative in umi_to_representative.items():
+                if umi != representative:
+                    umi_to_family[representative].alns.extend(umi_to_family[umi].alns)
+                    merged_away.add(id(umi_to_family[umi]))
+        return [family for family in families if id(family) not in merged_away]
+
+    def _flush_while(self, is_flushed) -> List[ReadFamily]:
+        ret = []
+        while self.open_family_queue and is_flushed(self.open_family_queue[0]):
+            family = self.open_family_queue.popleft()
+            del self.open_families[family.key]
+            self.stats.n_open_reads -= len(family.alns)
+            ret.append(family)
+        if self.umi_cluster_mode != UMI_CLUSTER_MODE_NONE and (self.dedup_idflag & 0x8) and len(ret) > 1:
+            ret = self._merge_by_umi_clusters(ret)
+        self.stats.n_flushed_families += len(ret)
+        self.stats.n_open_families = len(self.open_families)
+        return ret
+
+    def flush_before(self, tid: int, cursor_pos: uvc1_refgpos_t) -> List[ReadFamily]:
+        """Flush the families that cannot receive reads at or after cursor_pos on contig tid."""
+        return self._flush_while(lambda family: family.tid != tid or family.leftmost_pos + self.max_insert_size < cursor_pos)
+
+    def flush_all(self) -> List[ReadFamily]:
+        return self._flush_while(lambda family: True)
+
+    def add(self, aln) -> List[ReadFamily]:
+        """Add one read and return the families that are complete because the cursor has moved past them."""
+        if aln.is_unmapped:
+            self.stats.n_skipped_reads += 1
+            return []
+        ret = self.flush_before(aln.reference_id, aln.reference_start)
+        key = molecular_barcode_from_alignment(aln, self.dedup_idflag).createKey()
+        family = self.open_families.get(key)
+        if family is None:
+            family = ReadFamily(key, aln.reference_id, aln.reference_start)
+            self.open_families[key] = family
+            self.open_family_queue.append(family)
+        family.alns.append(aln)
+        self.stats.n_reads += 1
+        self.stats.n_open_reads += 1
+        self.stats.n_open_families = len(self.open_families)
+        self.stats.peak_open_families = max(self.stats.peak_open_families, self.stats.n_open_families)
+        self.stats.peak_open_reads = max(self.stats.peak_open_reads, self.stats.n_open_reads)
+        return ret
+
+    def group(self, alns: Iterable) -> Iterator[ReadFamily]:
+        for aln in alns:
+            yield from self.add(aln)
+        yield from self.flush_all()
+
+def swap_duplex_umi(umistring: str) -> str:
+    """Swap the two halves of a duplex UMI (for example, AAA+CCC becomes CCC+AAA)."""
+    halves = umistring.split(DUPLEX_UMI_SEP)
+    return DUPLEX_UMI_SEP.join(reversed(halves)) if len(halves) == 2 else umistring
+
+def get_duplex_strand_key(key: MolecularBarcode) -> Tuple[Tuple, int]:
+    """
+    Return the strand-canonical key of a family and the strand of the family (0 for top and 1 for bottom).
+
+    The fragment ends are ordered as createKey() does with min/max, and the UMI is expressed in the
+    orientation of the top strand, because the bottom strand reads the two halves of the UMI in
+    swapped order. A family and its complementary-strand partner thus have the same key.
+    """
+    beg_tidpos_pair, end_tidpos_pair, _, umistring, duplexflag, dedup_idflag = key.createKeyTuple()
+    strand = duplexflag & 0x1
+    return ((min(beg_tidpos_pair, end_tidpos_pair), max(beg_tidpos_pair, end_tidpos_pair),
+             (swap_duplex_umi(umistring) if strand else umistring), dedup_idflag), strand)
+
+class DuplexPairingStats:
+    def __init__(self):
+        self.n_families = 0
+        self.n_paired = 0
+        self.n_unpaired = 0
+        self.n_conflicting = 0
+
+    def __str__(self) -> str:
+        return (f"DuplexPairingStats(n_families={self.n_families} n_paired={self.n_paired} "
+                f"n_unpaired={self.n_unpaired} n_conflicting={self.n_conflicting})")
+
+class DuplexPairingIndex:
+    """
+    Find the complementary-strand partner of each family in O(1) by its strand-canonical key.
+
+    A family waits in the index until its partner arrives. Families from StreamingFamilyGrouper come
+    in order of leftmost position, so a family that is more than max_insert_size behind the latest
+    family cannot be paired anymore and is released as unpaired.
+    """
+    def __init__(self, max_insert_size: int = MAX_INSERT_SIZE):
+        self.max_insert_size = max_insert_size
+        self.waiting: Dict[Tuple, List[Optional[ReadFamily]]] = {}
+        self.waiting_queue = deque()
+        self.stats = DuplexPairingStats()
+
+    def add(self, family: ReadFamily) -> Optional[Tuple[ReadFamily, ReadFamily]]:
+        """Add a family and return the (top, bottom) pair if its partner was waiting."""
+        self.stats.n_families += 1
+        strand_key, strand = get_duplex_strand_key(family.key)
+        strands = self.waiting.get(strand_key)
+        if strands is None:
+            strands = [None, None]
+            strands[strand] = family
+            self.waiting[strand_key] = strands
+            self.waiting_queue.append((strand_key, family))
+            return None
+        if strands[strand] is not None:
+            # Two families on the same strand with the same key, which happens only if dedup_idflag ignores the UMI.
+            self.stats.n_conflicting += 1
+            strands[strand].alns.extend(family.alns)
+            return None
+        strands[strand] = family
+        del self.waiting[strand_key]
+        self.stats.n_paired += 1
+        return strands[0], strands[1]
+
+    def pop_unpaired_before(self, tid: int, pos: uvc1_refgpos_t) -> List[ReadFamily]:
+        ret = []
+        while self.waiting_queue:
+            strand_key, family = self.waiting_queue[0]
+            if family.tid == tid and family.leftmost_pos + self.max_insert_size >= pos:
+                break
+            self.waiting_queue.popleft()
+            strands = self.waiting.get(strand_key)
+            if strands is not None and family in strands:
+                del self.waiting[strand_key]
+                ret.append(family)
+        self.stats.n_unpaired += len(ret)
+        return ret
+
+    def pop_all_unpaired(self) -> List[ReadFamily]:
+        return self.pop_unpaired_before(-1, -1)
+
+def iter_duplex_pairs(families: Iterable[ReadFamily], max_insert_size: int = MAX_INSERT_SIZE, disable_duplex: bool = False
+                      ) -> Iterator[Tuple[Optional[ReadFamily], Optional[ReadFamily]]]:
+    """
+    Yield (top, bottom) family pairs, where an unpaired family comes with None as its partner.
+
+    If disable_duplex is True, every family is yielded unpaired.
+    """
+    if disable_duplex:
+        for family in families:
+            yield ((family, None) if (family.key.duplexflag & 0x1) == 0 else (None, family))
+        return
+    index = DuplexPairingIndex(max_insert_size)
+    def unpaired_pairs(unpaired):
+        return [((family, None) if (family.key.duplexflag & 0x1) == 0 else (None, family)) for family in unpaired]
+    for family in families:
+        yield from unpaired_pairs(index.pop_unpaired_before(family.tid, family.leftmost_pos))
+        pair = index.add(family)
+        if pair is not None:
+            yield pair
+    yield from unpaired_pairs(index.pop_all_unpaired())
@@ -1,4 +1,5 @@
 from commonClasses import *
+import numpy as np
 BASE = 31
 
 STATIC_REV_COMPLEMENT = {
@@ -26,3 +27,181 @@ def strhash(s, base=BASE):
 
 def hash2hash(hash1, hash2):
     return hash1 * ((1 << 31) - 1) + hash2
+
+
+# Fixed-width hashing: the same polynomial hash as strnhash, but computed modulo 2^64 on uint8 buffers.
+# For inputs of at most STRNHASH64_MAX_EXACT_LEN characters, strnhash never exceeds 2^64 and both give the same value.
+HASH64_MASK = (1 << 64) - 1
+STRNHASH64_MAX_EXACT_LEN = 12
+STRNHASH64_NUMPY_MIN_LEN = 64
+
+_HASH64_POWERS = {}
+
+def hash64_powers(length, base=BASE):
+    """Return [base^(length-1), ..., base^1, base^0] modulo 2^64 as a uint64 array."""
+    powers = _HASH64_POWERS.get(base)
+    if powers is None or len(powers) < length:
+        powers = np.ones(max(length, 64), dtype=np.uint64)
+        powers[1:] = np.uint64(base)
+        powers = np.cumprod(powers, dtype=np.uint64)
+        _HASH64_POWERS[base] = powers
+    return powers[:length][::-1]
+
+def to_uint8_buffer(s):
+    if isinstance(s, np.ndarray):
+        return s.astype(np.uint8, copy=False)
+    if isinstance(s, str):
+        s = s.encode()
+    return np.frombuffer(s, dtype=np.uint8)
+
+def strnhash64(s, n, base=BASE, is_compat=False):
+    """
+    Hash the first n characters of s modulo 2^64.
+
+    If is_compat is True, inputs longer than STRNHASH64_MAX_EXACT_LEN are hashed with the unbounded
+    strnhash instead, so that every value is the same as before.
+    """
+    if not isinstance(s, np.ndarray) and min(n, len(s)) < STRNHASH64_NUMPY_MIN_LEN:
+        # Calling into NumPy costs more than a short loop.
+        chars = (s.encode() if isinstance(s, str) else s)[:n]
+        if is_compat and len(chars) > STRNHASH64_MAX_EXACT_LEN:
+            return strnhash(chars.decode(), n, base)
+        # Masking once at the end gives the same value, and the intermediate ints stay small for short inputs.
+        ret = 0
+        for char in chars:
+            ret = ret * base + char
+        return ret & HASH64_MASK
+    buf = to_uint8_buffer(s)[:n]
+    if is_compat and len(buf) > STRNHASH64_MAX_EXACT_LEN:
+        return strnhash(buf.tobytes().decode(), n, base)
+    return int(np.dot(buf.astype(np.uint64), hash64_powers(len(buf), base)))
+
+def strhash64(s, base=BASE, is_compat=False):
+    return strnhash64(s, len(s), base, is_compat)
+
+def pack_right_aligned(seqs):
+    """Stack sequences into a zero-padded 2D uint8 array in which each sequence ends at the last column."""
+    bufs = [to_uint8_buffer(s) for s in seqs]
+    lens = np.array([len(buf) for buf in bufs], dtype=np.int64)
+    ret = np.zeros((len(bufs), int(lens.max()) if len(bufs) else 0), dtype=np.uint8)
+    for i, buf in enumerate(bufs):
+        if len(buf):
+            ret[i, -len(buf):] = buf
+    return ret, lens
+
+def batch_strhash64(seqs, base=BASE):
+    """
+    Hash many sequences modulo 2^64 in one matrix-vector product.
+
+    The sequences are right-aligned, so the zero padding on the left does not change their hashes.
+
+    :return: A uint64 array with the hash of each sequence.
+    """
+    mat, _ = pack_right_aligned(seqs)
+    return mat.astype(np.uint64) @ hash64_powers(mat.shape[1], base)
+
+def rolling_strnhash64(s, k, base=BASE):
+    """
+    Hash every k-length window of s modulo 2^64 in one pass.
+
+    :return: A uint64 array whose element i is strnhash64(s[i:i+k], k).
+    """
+    buf = to_uint8_buffer(s)
+    if k <= 0 or len(buf) < k:
+        return np.zeros(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(buf, k)
+    return windows.astype(np.uint64) @ hash64_powers(k, base)
+
+
+# Canonical hashing: the forward hash (as strnhash64) and the reverse-complement hash (as strnhash_rc modulo 2^64) in one pass.
+REV_COMPLEMENT_TABLE = np.arange(256, dtype=np.uint8)
+for _base, _complement in STATIC_REV_COMPLEMENT.items():
+    REV_COMPLEMENT_TABLE[ord(_base)] = ord(_complement)
+REV_COMPLEMENT_BYTES = REV_COMPLEMENT_TABLE.tobytes()
+
+def hash64_inverse_powers(length, base=BASE):
+    """Return [1, base^-1, ..., base^-(length-1)] modulo 2^64 as a uint64 array, which requires an odd base."""
+    ret = np.ones(max(length, 1), dtype=np.uint64)
+    ret[1:] = np.uint64(pow(base, -1, 1 << 64))
+    return np.cumprod(ret, dtype=np.uint64)[:length]
+
+def canonical_strnhash64(s, n, base=BASE):
+    """
+    Hash the first n characters of s and their reverse complement modulo 2^64.
+
+    Short str and bytes inputs are hashed by one loop that builds both hashes together, walking the
+    characters forwards and their complements backwards. Longer inputs use two dot products with
+    the same powers of the base, one on the buffer and one on its complement from REV_COMPLEMENT_TABLE.
+
+    :return: The tuple (forward hash, reverse-complement hash, strand-independent minimum of both).
+    """
+    if not isinstance(s, np.ndarray) and min(n, len(s)) < STRNHASH64_NUMPY_MIN_LEN:
+        # Calling into NumPy costs more than a short loop, see strnhash64.
+        chars = (s.encode() if isinstance(s, str) else s)[:n]
+        fwd = 0
+        rc = 0
+        for char, rc_char in zip(chars, reversed(chars.translate(REV_COMPLEMENT_BYTES))):
+            fwd = fwd * base + char
+            rc = rc * base + rc_char
+        fwd &= HASH64_MASK
+        rc &= HASH64_MASK
+        return fwd, rc, min(fwd, rc)
+    buf = to_uint8_buffer(s)[:n].astype(np.uint64)
+    powers = hash64_powers(len(buf), base)
+    fwd = int(np.dot(buf, powers))
+    rc = int(np.dot(REV_COMPLEMENT_TABLE[buf.astype(np.uint8)].astype(np.uint64), powers[::-1]))
+    return fwd, rc, min(fwd, rc)
+
+def batch_canonical_strhash64(seqs, base=BASE):
+    """
+    Canonical hashes of many sequences, see canonical_strnhash64.
+
+    The sequences are left-aligned so that the reverse-complement hash is a single matrix-vector
+    product. The forward hash is computed from the same matrix and then divided by the extra
+    powers of the base that its right padding adds, which is exact modulo 2^64 for an odd base.
+
+    :return: Three uint64 arrays with the forward, reverse-complement and canonical hash of each sequence.
+    """
+    bufs = [to_uint8_buffer(s) for s in seqs]
+    lens = np.array([len(buf) for buf in bufs], dtype=np.int64)
+    maxlen = int(lens.max()) if len(bufs) else 0
+    mat = np.zeros((len(bufs), maxlen), dtype=np.uint8)
+    for i, buf in enumerate(bufs):
+        mat[i, :len(buf)] = buf
+    powers = hash64_powers(maxlen, base)
+    rc = REV_COMPLEMENT_TABLE[mat].astype(np.uint64) @ powers[::-1].copy()
+    if base % 2 == 1:
+        fwd = (mat.astype(np.uint64) @ powers) * hash64_inverse_powers(maxlen + 1, base)[maxlen - lens]
+    else:
+        fwd = batch_strhash64(bufs, base)
+    return fwd, rc, np.minimum(fwd, rc)
+
+
+# Bounded mixing: hash2hash reduced modulo 2^64 (or 2^128), so that chained keys keep a fixed width instead of
+# growing by 31 bits per call. hash2hash64 is only the masked multiply-add, and a chained key is scrambled once
+# with the splitmix64 finalizer (mix64) when it is complete. hash2hash128 scrambles at every call.
+HASH128_MASK = (1 << 128) - 1
+HASH64_GOLDEN = 0x9E3779B97F4A7C15
+
+def mix64(x):
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & HASH64_MASK
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & HASH64_MASK
+    return x ^ (x >> 31)
+
+def hash2hash64(hash1, hash2):
+    return (hash1 * ((1 << 31) - 1) + hash2) & HASH64_MASK
+
+def hash2hash128(hash1, hash2):
+    x = (hash1 * ((1 << 31) - 1) + hash2) & HASH128_MASK
+    lo = mix64((x & HASH64_MASK) ^ mix64(x >> 64))
+    hi = mix64((x >> 64) ^ mix64((x & HASH64_MASK) ^ HASH64_GOLDEN))
+    return (hi << 64) | lo
+
+def mix64_array(x):
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def hash2hash64_array(hash1, hash2):
+    """Element-wise hash2hash64 of two uint64 arrays."""
+    return hash1.astype(np.uint64) * np.uint64((1 << 31) - 1) + hash2.astype(np.uint64)
@@ -1,4 +1,6 @@
+from array import array
 from collections import defaultdict
+from typing import Dict, List, Tuple
 import numpy as np
 
 # Define required constants
@@ -72,6 +74,14 @@ def fill_by_indel_info(fmt, symbol2CountCoverageSet, strand, refpos, symbol, bq_
 
         bqfq_depth_mutform_tuples.append((fqdata, bqdata, fqdata_c2DP, fqdata_c2dDP, indelstring))
 
+    return append_indel_depths(fmt, strand, bqfq_depth_mutform_tuples)
+
+def append_indel_depths(fmt, strand, bqfq_depth_mutform_tuples):
+    """
+    Append the (fqdata, bqdata, fqdata_c2DP, fqdata_c2dDP, indelstring) tuples of one position to fmt in decreasing order of bqdata.
+
+    :return: The maxdiff statistic and the sum of bqdata.
+    """
     gapbAD1sum = 0
     gapcAD1sum = 0
     bqfq_depth_mutform_tuples.sort(reverse=True, key=lambda x: x[1])  # Sorting by bqdata, for example
@@ -108,3 +118,230 @@ def fill_by_indel_info(fmt, symbol2CountCoverageSet, strand, refpos, symbol, bq_
         gapcAD1sum += gap_cAD
 
     return max(maxdiff, prev_gap_cAD), gapcAD1sum
+
+INDEL_TYPE_INS = 0
+INDEL_TYPE_DEL = 1
+
+class IndelEvidenceTable:
+    """
+    Columnar table of the indel depths, with one row per (refpos, indel) and one column per depth.
+
+    It replaces the four {refpos: {indel: depth}} dicts passed to fill_by_indel_info, so that one
+    lookup returns all four depths of an indel. The depths are stored in typed arrays instead of as
+    dict values, and the rows of each position are kept in the order in which their indels were
+    first added, which is the iteration order of the dicts. Like the dicts, a table holds the indels
+    of one type (insertions or deletions), so a row number identifies a (refpos, type, indel)
+    allele and is used as its integer ID.
+    """
+    def __init__(self, indel_type: int = INDEL_TYPE_INS):
+        self.indel_type = indel_type
+        self.row_refpos = array('q')
+        self.row_indel: List = []
+        self.bq_depth = array('q')
+        self.fq_depth = array('q')
+        self.fq_depth_c2DP = array('q')
+        self.fq_depth_c2dDP = array('q')
+        self.key_to_row: Dict[Tuple[int, object], int] = {}
+        self.refpos_to_rows: Dict[int, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.row_refpos)
+
+    def get_row(self, refpos: int, indel) -> int:
+        """Return the row of (refpos, indel), adding a row with zero depths if there is none."""
+        row = self.key_to_row.get((refpos, indel))
+        if row is None:
+            row = len(self.row_refpos)
+            self.key_to_row[(refpos, indel)] = row
+            self.refpos_to_rows.setdefault(refpos, []).append(row)
+            self.row_refpos.append(refpos)
+            self.row_indel.append(indel)
+            for column in (self.bq_depth, self.fq_depth, self.fq_depth_c2DP, self.fq_depth_c2dDP):
+                column.append(0)
+        return row
+
+    def add(self, refpos: int, indel, bq_depth: int = 0, fq_depth: int = 0, fq_depth_c2DP: int = 0, fq_depth_c2dDP: int = 0) -> int:
+        row = self.get_row(refpos, indel)
+        self.bq_depth[row] += bq_depth
+        self.fq_depth[row] += fq_depth
+        self.fq_depth_c2DP[row] += fq_depth_c2DP
+        self.fq_depth_c2dDP[row] += fq_depth_c2dDP
+        return row
+
+    def get(self, refpos: int, indel) -> Tuple[int, int, int, int]:
+        """Return the bq, fq, fq_c2DP and fq_c2dDP depths of an indel, which are zero if it was never added."""
+        row = self.key_to_row.get((refpos, indel))
+        if row is None:
+            return 0, 0, 0, 0
+        return self.bq_depth[row], self.fq_depth[row], self.fq_depth_c2DP[row], self.fq_depth_c2dDP[row]
+
+    def has_refpos(self, refpos: int) -> bool:
+        return refpos in self.refpos_to_rows
+
+    def rows_at(self, refpos: int) -> List[int]:
+        return self.refpos_to_rows.get(refpos, [])
+
+    @classmethod
+    def from_depth_dicts(cls, bq_tsum_depth, fq_tsum_depth, fq_tsum_depth_c2DP, fq_tsum_depth_c2dDP,
+                         indel_type: int = INDEL_TYPE_INS) -> 'IndelEvidenceTable':
+        ret = cls(indel_type)
+        # bq_tsum_depth goes first, so that the rows of each position follow its iteration order.
+        for refpos, indel_to_depth in bq_tsum_depth.items():
+            for indel, depth in indel_to_depth.items():
+                ret.add(refpos, indel, bq_depth=depth)
+        for depth_map, column in ((fq_tsum_depth, ret.fq_depth), (fq_tsum_depth_c2DP, ret.fq_depth_c2DP),
+                                  (fq_tsum_depth_c2dDP, ret.fq_depth_c2dDP)):
+            for refpos, indel_to_depth in depth_map.items():
+                for indel, depth in indel_to_depth.items():
+                    column[ret.get_row(refpos, indel)] += depth
+        return ret
+
+class IndelAlleleTable:
+    """
+    Deferred allele strings of the rows of an IndelEvidenceTable, whose row numbers are the allele IDs.
+
+    Comparing, sorting and hashing alleles are integer operations on the row numbers. The allele
+    string is only materialized by get_indel_string when it is first asked for (at VCF output) and
+    is then cached. Its length is computed without slicing refchars. The table belongs to one
+    region, because the materialized strings depend on its refchars and symbol2CountCoverageSet.
+    """
+    def __init__(self, indel_table: IndelEvidenceTable, refchars, symbol2CountCoverageSet):
+        self.indel_table = indel_table
+        self.refchars = refchars
+        self.symbol2CountCoverageSet = symbol2CountCoverageSet
+        self.id_to_string: Dict[int, str] = {}
+
+    def get_string(self, allele_id: int) -> str:
+        ret = self.id_to_string.get(allele_id)
+        if ret is None:
+            ret = get_indel_string(self.indel_table.row_indel[allele_id], self.indel_table.row_refpos[allele_id],
+                                   self.refchars, self.symbol2CountCoverageSet)
+            self.id_to_string[allele_id] = ret
+        return ret
+
+    def get_string_len(self, allele_id: int) -> int:
+        indel = self.indel_table.row_indel[allele_id]
+        if INDEL_ID == 1:
+            return len(indel)
+        # The length of the slice taken by get_indel_string, which slicing a range gives in O(1).
+        refpos = self.indel_table.row_refpos[allele_id]
+        return len(range(len(self.refchars))[refpos - self.symbol2CountCoverageSet.getUnifiedIncluBegPosition():refpos + len(indel)])
+
+def fill_by_indel_table(fmt, symbol2CountCoverageSet, strand, refpos, symbol, indel_table: IndelEvidenceTable, refchars, specialflag):
+    """The same as fill_by_indel_info, with the depths read from one IndelEvidenceTable instead of four dicts."""
+    assert isSymbolIns(symbol) or isSymbolDel(symbol), f"Invalid symbol: {symbol}"
+    assert indel_table.has_refpos(refpos), f"Reference position {refpos} not found in indel_table"
+
+    bqfq_depth_mutform_tuples = []
+    for row in indel_table.rows_at(refpos):
+        bqdata = indel_table.bq_depth[row]
+        # Rows added only by the fq depths are not in bq_tsum_depth, so fill_by_indel_info does not visit them.
+        if bqdata == 0:
+            continue
+        indelstring = get_indel_string(indel_table.row_indel[row], refpos, refchars, symbol2CountCoverageSet)
+        if not indelstring:
+            continue
+        bqfq_depth_mutform_tuples.append((indel_table.fq_depth[row], bqdata, indel_table.fq_depth_c2DP[row],
+                                          indel_table.fq_depth_c2dDP[row], indelstring))
+    return append_indel_depths(fmt, strand, bqfq_depth_mutform_tuples)
+
+class IndelFillBatch:
+    """
+    Result of fill_by_indel_table for many (strand, refpos) calls, as offset-indexed arrays.
+
+    The indels of call i are at [offsets[i], offsets[i + 1]) of gapSeq, gapbAD1, gapcAD1, gc2AD and
+    gc2dAD, in the order in which fill_by_indel_table appends them, and gapN[i], maxdiff[i] and
+    gapcAD1sum[i] are what it appends to gapNf or gapNr and returns.
+    """
+    def __init__(self, strands, offsets, gapSeq, gapbAD1, gapcAD1, gc2AD, gc2dAD, maxdiff, gapcAD1sum):
+        self.strands = strands
+        self.offsets = offsets
+        self.gapN = np.diff(offsets)
+        self.gapSeq = gapSeq
+        self.gapbAD1 = gapbAD1
+        self.gapcAD1 = gapcAD1
+        self.gc2AD = gc2AD
+        self.gc2dAD = gc2dAD
+        self.maxdiff = maxdiff
+        self.gapcAD1sum = gapcAD1sum
+
+    def __len__(self) -> int:
+        return len(self.strands)
+
+    def append_to(self, fmt, indel_alleles: 'IndelAlleleTable' = None) -> None:
+        """
+        Append the indels of all the calls to fmt, the same as calling fill_by_indel_table for each call in order.
+
+        If gapSeq holds allele IDs, indel_alleles must be the IndelAlleleTable that they were taken from.
+        """
+        for strand, gapN in zip(self.strands.tolist(), self.gapN.tolist()):
+            (fmt.gapNf if strand == 0 else fmt.gapNr).append(gapN)
+        fmt.gapSeq.extend(self.gapSeq if indel_alleles is None else [indel_alleles.get_string(allele_id) for allele_id in self.gapSeq])
+        fmt.gapbAD1.extend(self.gapbAD1.tolist())
+        fmt.gapcAD1.extend(self.gapcAD1.tolist())
+        fmt.gc2AD.extend(self.gc2AD.tolist())
+        fmt.gc2dAD.extend(self.gc2dAD.tolist())
+
+def fill_by_indel_table_batch(
+    symbol2CountCoverageSet, strands, refposes, indel_table: IndelEvidenceTable, refchars,
+    indel_alleles: IndelAlleleTable = None
+) -> IndelFillBatch:
+    """
+    Compute fill_by_indel_table for all the (strands[i], refposes[i]) calls of a region at once.
+
+    The indels of all the calls are gathered into flat arrays, then ordered by call and by
+    decreasing bq depth with one stable lexsort, and the maxdiff statistics and the depth sums are
+    computed per call with reduceat. If indel_alleles (over indel_table) is given, gapSeq holds the
+    allele IDs instead of the strings, and no allele string is materialized until
+    IndelAlleleTable.get_string is called, for example by IndelFillBatch.append_to.
+    """
+    strands = np.asarray(strands, dtype=np.int64)
+    call_idxs, rows, gap_seqs = [], [], []
+    for call_idx, refpos in enumerate(refposes):
+        assert indel_table.has_refpos(refpos), f"Reference position {refpos} not found in indel_table"
+        for row in indel_table.rows_at(refpos):
+            if indel_table.bq_depth[row] == 0:
+                continue
+            indel = indel_table.row_indel[row]
+            if indel_alleles is not None:
+                if indel_alleles.get_string_len(row) == 0:
+                    continue
+                call_idxs.append(call_idx)
+                rows.append(row)
+                gap_seqs.append(row)
+                continue
+            indelstring = get_indel_string(indel, refpos, refchars, symbol2CountCoverageSet)
+            if not indelstring:
+                continue
+            call_idxs.append(call_idx)
+            rows.append(row)
+            gap_seqs.append(indelstring)
+    n_calls = len(strands)
+    call_idxs = np.array(call_idxs, dtype=np.int64)
+    rows = np.array(rows, dtype=np.int64)
+    def column(depths):
+        return np.frombuffer(depths, dtype=np.int64)[rows] if len(depths) else np.zeros(0, dtype=np.int64)
+    bq = column(indel_table.bq_depth)
+    # np.lexsort is stable, so equal depths keep their table order, the same as the stable list sort.
+    order = np.lexsort((-bq, call_idxs))
+    call_idxs, bq, gap_seqs = call_idxs[order], bq[order], [gap_seqs[idx] for idx in order]
+    fq, fq_c2DP, fq_c2dDP = (column(depths)[order] for depths in
+                             (indel_table.fq_depth, indel_table.fq_depth_c2DP, indel_table.fq_depth_c2dDP))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(call_idxs, minlength=n_calls))))
+
+    seq_lens = np.fromiter(((indel_alleles.get_string_len(gap_seq) if indel_alleles is not None else len(gap_seq))
+                            for gap_seq in gap_seqs), dtype=np.int64, count=len(gap_seqs))
+    # A drop in bq depth counts between consecutive indels of the same call with different lengths.
+    diffs = np.zeros(len(bq), dtype=np.int64)
+    if len(bq) > 1:
+        is_counted = (call_idxs[1:] == call_idxs[:-1]) & (seq_lens[1:] != seq_lens[:-1]) & (bq[:-1] > bq[1:])
+        diffs[1:] = np.where(is_counted, bq[:-1] - bq[1:], 0)
+    maxdiff = np.zeros(n_calls, dtype=np.int64)
+    gapcAD1sum = np.zeros(n_calls, dtype=np.int64)
+    is_nonempty = offsets[1:] > offsets[:-1]
+    if is_nonempty.any():
+        group_begs = offsets[:-1][is_nonempty]
+        last_bq = bq[offsets[1:][is_nonempty] - 1]
+        maxdiff[is_nonempty] = np.maximum(np.maximum.reduceat(diffs, group_begs), last_bq)
+        gapcAD1sum[is_nonempty] = np.add.reduceat(bq, group_begs)
+    return IndelFillBatch(strands, offsets, gap_seqs, fq, bq, fq_c2DP, fq_c2dDP, maxdiff, gapcAD1sum)
@@ -1,27 +1,905 @@
 from iohtsDeclaration import * 
 from commonClasses import * 
+import gzip
+import hashlib
+import heapq
+import numpy as np
+import os
+import queue
 import pysam
-from typing import List
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
 
 def is_valid(tid: int, tname: str, beg_pos: int, end_pos: int) -> bool:
 
     return ((tid >= 0 or len(tname) > 0) and beg_pos < end_pos)
 
+class BamRecordStream:
+    """
+    Coordinate-ordered stream over the BAM records of one region.
+
+    Unlike load_bam_records, the records are not collected into a list. The stream keeps only the
+    reads that overlap the current pileup position (the window) and releases each read as soon as
+    the window start has moved past its reference end position, so memory is bounded by the depth
+    of the region rather than by its total number of reads.
+    """
+    def __init__(
+        self,
+        samfile: pysam.AlignmentFile,
+        query_tid: int,
+        query_beg: int,
+        query_end: int,
+        batch_size: int = DEFAULT_STREAM_BATCH_SIZE
+    ):
+        self.samfile = samfile
+        self.query_tid = query_tid
+        self.query_beg = query_beg
+        self.query_end = query_end
+        self.batch_size = max(1, batch_size)
+        self.window_beg = query_beg
+        self.n_streamed_reads = 0
+        self.n_released_reads = 0
+        self.peak_resident_reads = 0
+        self._resident = []  # min-heap of (reference_end, streaming order, read)
+
+    @property
+    def n_resident_reads(self) -> int:
+        return len(self._resident)
+
+    def window_reads(self) -> List[pysam.AlignedSegment]:
+        """Return the reads that still overlap the current pileup window."""
+        return [item[2] for item in self._resident]
+
+    def advance_window(self, window_beg: int) -> int:
+        """
+        Move the pileup window start to window_beg and release every read ending at or before it.
+
+        :return: The number of reads released by this call.
+        """
+        self.window_beg = max(self.window_beg, window_beg)
+        n_released = 0
+        while self._resident and self._resident[0][0] <= self.window_beg:
+            heapq.heappop(self._resident)
+            n_released += 1
+        self.n_released_reads += n_released
+        return n_released
+
+    def _fetch(self) -> Iterator[pysam.AlignedSegment]:
+        try:
+            ref_name = self.samfile.get_reference_name(self.query_tid)
+            for aln in self.samfile.fetch(ref_name, self.query_beg, self.query_end):
+                yield aln
+        except ValueError as e:
+            print(f"Error querying region: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    def __iter__(self) -> Iterator[pysam.AlignedSegment]:
+        for aln in self._fetch():
+            # The input is coordinate-sorted, so no read that is yet to come can start before this one.
+            self.advance_window(aln.reference_start)
+            end_pos = aln.reference_end if aln.reference_end is not None else aln.reference_start + 1
+            heapq.heappush(self._resident, (end_pos, self.n_streamed_reads, aln))
+            self.n_streamed_reads += 1
+            self.peak_resident_reads = max(self.peak_resident_reads, len(self._resident))
+            yield aln
+        self.advance_window(self.query_end)
+
+    def iter_batches(self) -> Iterator[List[pysam.AlignedSegment]]:
+        """Yield the reads of the region in coordinate order as lists of at most batch_size reads."""
+        batch = []
+        for aln in self:
+            batch.append(aln)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def stream_bam_records(
+    samfile: pysam.AlignmentFile,
+    query_tid: int,
+    query_beg: int,
+    query_end: int,
+    batch_size: int = DEFAULT_STREAM_BATCH_SIZE
+) -> BamRecordStream:
+    return BamRecordStream(samfile, query_tid, query_beg, query_end, batch_size)
+
 def load_bam_records(
     samfile: pysam.AlignmentFile,
     query_tid: int,
     query_beg: int,
     query_end: int
 ) -> List[pysam.AlignedSegment]:
-    alignments = []
-    try:
-        ref_name = samfile.get_reference_name(query_tid)
-        for aln in samfile.fetch(ref_name, query_beg, query_end):
-            alignments.append(aln)
-    except ValueError as e:
-        print(f"Error querying region: {e}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-    return alignments
-# BedLine, load_bam_records
+    # Materializes the whole region, prefer stream_bam_records for deep regions.
+    return list(BamRecordStream(samfile, query_tid, query_beg, query_end))
+
+def is_cram_fname(fname: str) -> bool:
+    return fname.endswith(".cram")
+
+def decompression_thread_num(max_cpu_num: int, n_processes: int = 1) -> int:
+    """Number of htslib decompression threads per opened file so that all processes together use max_cpu_num CPUs."""
+    return max(1, max_cpu_num // max(1, n_processes))
+
+def _ref_md5_cache_fname(ref_cache_dir: str, md5: str) -> str:
+    return os.path.join(ref_cache_dir, md5[0:2], md5[2:4], md5[4:])
+
+def _write_ref_md5_cache_entry(cache_fname: str, seq: bytes) -> None:
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    tmp_fname = f"{cache_fname}.tmp.{os.getpid()}"
+    with open(tmp_fname, "wb") as cache_file:
+        cache_file.write(seq)
+    os.replace(tmp_fname, cache_fname)
+
+def build_ref_md5_cache(fasta_fname: str, ref_cache_dir: str, name_to_md5: Dict[str, str] = None) -> Dict[str, str]:
+    """
+    Populate a local htslib reference cache with the contigs of fasta_fname.
+
+    Each contig is stored under ref_cache_dir/xx/yy/<MD5>, where the MD5 is computed over the
+    upper-case sequence as in the M5 tag of the CRAM header, so that htslib finds the reference
+    of every CRAM slice locally. Existing cache entries are kept.
+
+    If name_to_md5 (for example, from the M5 tags of a CRAM header) is provided, only the contigs in
+    it whose cache entry is missing are read and hashed, and a contig whose MD5 differs from the
+    expected one is not cached. Otherwise, every contig is read and hashed, which is meant to be
+    done once in the parent process before the workers start.
+
+    :return: A dict from contig name to its MD5 for the contigs that are cached.
+    """
+    ret = {}
+    with pysam.FastaFile(fasta_fname) as fasta:
+        for name in (fasta.references if name_to_md5 is None else name_to_md5):
+            if name_to_md5 is not None:
+                if os.path.exists(_ref_md5_cache_fname(ref_cache_dir, name_to_md5[name])):
+                    ret[name] = name_to_md5[name]
+                    continue
+                if name not in fasta:
+                    continue
+            seq = fasta.fetch(name).upper().encode()
+            md5 = hashlib.md5(seq).hexdigest()
+            if name_to_md5 is not None and md5 != name_to_md5[name]:
+                continue
+            ret[name] = md5
+            cache_fname = _ref_md5_cache_fname(ref_cache_dir, md5)
+            if not os.path.exists(cache_fname):
+                _write_ref_md5_cache_entry(cache_fname, seq)
+    return ret
+
+def cram_header_md5s(cram_fname: str) -> Dict[str, str]:
+    """Return the M5 tag of each @SQ line of a CRAM header, which is read without decoding any slice."""
+    with pysam.AlignmentFile(cram_fname, "rc") as samfile:
+        return {sq["SN"]: sq["M5"].lower() for sq in samfile.header.to_dict().get("SQ", []) if "M5" in sq}
+
+def use_local_ref_cache(ref_cache_dir: str) -> None:
+    # Setting REF_PATH also prevents htslib from falling back to the remote reference server.
+    ref_path = os.path.join(ref_cache_dir, "%2s", "%2s", "%s")
+    os.environ["REF_PATH"] = ref_path
+    os.environ["REF_CACHE"] = ref_path
+
+def open_alignment_file(
+    fname: str,
+    reference_fname: str = "",
+    n_threads: int = 1,
+    ref_cache_dir: str = ""
+) -> pysam.AlignmentFile:
+    """
+    Open a BAM or CRAM file with n_threads htslib decompression threads.
+
+    For CRAM, if ref_cache_dir is provided, the reference is decoded from the local MD5 cache in
+    that directory. If reference_fname is also provided, the contigs listed with an M5 tag in the
+    CRAM header whose cache entry is missing are first added from reference_fname.
+    """
+    mode = "rb"
+    if is_cram_fname(fname):
+        mode = "rc"
+        if ref_cache_dir:
+            if reference_fname:
+                build_ref_md5_cache(reference_fname, ref_cache_dir, cram_header_md5s(fname))
+            use_local_ref_cache(ref_cache_dir)
+    return pysam.AlignmentFile(fname, mode, reference_filename=(reference_fname if reference_fname else None),
+                               threads=max(1, n_threads))
+
+def _index_pseudo_bin(depth: int) -> int:
+    return ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+
+def _index_first_leaf_bin(depth: int) -> int:
+    return ((1 << (depth * 3)) - 1) // 7
+
+class ContigIndexSummary:
+    def __init__(self):
+        self.ref_beg_voffset = 0
+        self.ref_end_voffset = 0
+        self.n_mapped = -1
+        self.n_unmapped = -1
+        # Smallest virtual offset of the reads overlapping each window of 1 << min_shift bases, zero if unknown.
+        self.window_voffsets: List[int] = []
+
+class BamIndexReadCountEstimator:
+    """
+    Estimate the number of reads in genomic regions from the BAM index alone.
+
+    The BAI or CSI index stores, for each contig, the number of mapped reads and the span of the
+    BGZF file holding them (in its pseudo-bin), and for each window of 1 << min_shift bases the
+    virtual offset of the first overlapping read (the linear index of BAI or the loffset of the
+    leaf bins of CSI). The compressed bytes between the offsets bounding a region, multiplied by the
+    contig's reads per compressed byte, approximate the region's read count at window resolution.
+    Contigs without usable index data fall back to the contig's mapped read density per base, and
+    exact=True counts the reads by iterating over them. If there is neither a BAI/CSI index nor any
+    mapped read count in the index statistics (as for a CRAM with a .crai, whose statistics report
+    zero mapped reads), the read counts are unknown and estimate returns -1.
+    """
+    def __init__(self, samfile: pysam.AlignmentFile, index_fname: str = ""):
+        self.samfile = samfile
+        self.min_shift = BAI_MIN_SHIFT
+        self.contigs: List[ContigIndexSummary] = []
+        self.index_fname = index_fname if index_fname else self.find_index_fname()
+        try:
+            if self.index_fname.endswith(".bai"):
+                self.load_bai(self.index_fname)
+            elif self.index_fname.endswith(".csi"):
+                self.load_csi(self.index_fname)
+        except (OSError, struct.error, ValueError) as e:
+            print(f"Error reading the index file {self.index_fname}: {e}")
+            self.contigs = []
+        self.mapped_per_contig = {}
+        try:
+            for stats in samfile.get_index_statistics():
+                self.mapped_per_contig[stats.contig] = stats.mapped
+        except (AttributeError, ValueError) as e:
+            print(f"Error retrieving index statistics: {e}")
+        self.has_read_counts = bool(self.contigs) or sum(self.mapped_per_contig.values()) > 0
+        if not self.has_read_counts:
+            print(f"No read counts in the index of {os.fsdecode(self.samfile.filename)}, so the read counts of its regions are unknown")
+
+    def find_index_fname(self) -> str:
+        fname = self.samfile.filename.decode() if isinstance(self.samfile.filename, bytes) else str(self.samfile.filename)
+        candidates = [fname + ".bai", fname + ".csi"]
+        if fname.endswith(".bam"):
+            candidates.append(fname[:-len(".bam")] + ".bai")
+        for candidate in candidates:
+            if os.path.exists(candidate):
+                return candidate
+        return ""
+
+    def load_bai(self, index_fname: str) -> None:
+        with open(index_fname, "rb") as index_file:
+            data = index_file.read()
+        if data[:4] != b"BAI\1":
+            raise ValueError("invalid BAI magic string")
+        pseudo_bin = _index_pseudo_bin(BAI_DEPTH)
+        (n_ref,) = struct.unpack_from("<i", data, 4)
+        offset = 8
+        for _ in range(n_ref):
+            contig = ContigIndexSummary()
+            (n_bin,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                if bin_id == pseudo_bin and n_chunk == 2:
+                    (contig.ref_beg_voffset, contig.ref_end_voffset,
+                     contig.n_mapped, contig.n_unmapped) = struct.unpack_from("<QQQQ", data, offset)
+                offset += 16 * n_chunk
+            (n_intv,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            contig.window_voffsets = list(struct.unpack_from(f"<{n_intv}Q", data, offset))
+            offset += 8 * n_intv
+            self.contigs.append(contig)
+
+    def load_csi(self, index_fname: str) -> None:
+        with gzip.open(index_fname, "rb") as index_file:
+            data = index_file.read()
+        if data[:4] != b"CSI\1":
+            raise ValueError("invalid CSI magic string")
+        min_shift, depth, l_aux = struct.unpack_from("<iii", data, 4)
+        self.min_shift = min_shift
+        pseudo_bin = _index_pseudo_bin(depth)
+        first_leaf_bin = _index_first_leaf_bin(depth)
+        offset = 16 + l_aux
+        (n_ref,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_ref):
+            contig = ContigIndexSummary()
+            leaf_loffsets = {}
+            (n_bin,) = struct.unpack_from("<i", data, offset)
+            offset += 4
+            for _ in range(n_bin):
+                bin_id, loffset, n_chunk = struct.unpack_from("<IQi", data, offset)
+                offset += 16
+                if bin_id == pseudo_bin and n_chunk == 2:
+                    (contig.ref_beg_voffset, contig.ref_end_voffset,
+                     contig.n_mapped, contig.n_unmapped) = struct.unpack_from("<QQQQ", data, offset)
+                elif bin_id >= first_leaf_bin:
+                    leaf_loffsets[bin_id - first_leaf_bin] = loffset
+                offset += 16 * n_chunk
+            contig.window_voffsets = [0] * ((max(leaf_loffsets) + 1) if leaf_loffsets else 0)
+            for window, loffset in leaf_loffsets.items():
+                contig.window_voffsets[window] = loffset
+            self.contigs.append(contig)
+
+    def _first_voffset_from(self, contig: ContigIndexSummary, window: int) -> int:
+        for voffset in contig.window_voffsets[max(window, 0):]:
+            if voffset > 0:
+                return voffset
+        return contig.ref_end_voffset
+
+    @staticmethod
+    def _voffset_to_nbytes(voffset: int) -> float:
+        # Compressed bytes up to the BGZF block, plus the in-block uncompressed offset converted to compressed bytes.
+        return (voffset >> 16) + (voffset & 0xFFFF) / BGZF_TYPICAL_COMPRESSION_RATIO
+
+    def _approx_nbytes_at(self, contig: ContigIndexSummary, pos: int, ref_len: int) -> float:
+        # Interpolate linearly within the window because the index only has window resolution.
+        window = pos >> self.min_shift
+        window_beg = window << self.min_shift
+        window_nbytes = self._voffset_to_nbytes(self._first_voffset_from(contig, window))
+        next_window_nbytes = self._voffset_to_nbytes(self._first_voffset_from(contig, window + 1))
+        frac = min(1.0, (pos - window_beg) / max(1, min(window_beg + (1 << self.min_shift), ref_len) - window_beg))
+        return window_nbytes + frac * (next_window_nbytes - window_nbytes)
+
+    def estimate(self, tid: int, beg_pos: int, end_pos: int, exact: bool = False) -> int:
+        if exact:
+            return self.samfile.count(self.samfile.get_reference_name(tid), beg_pos, end_pos)
+        if not self.has_read_counts:
+            return -1
+        if 0 <= tid < len(self.contigs) and self.contigs[tid].n_mapped >= 0:
+            contig = self.contigs[tid]
+            if contig.n_mapped == 0:
+                return 0
+            contig_nbytes = self._voffset_to_nbytes(contig.ref_end_voffset) - self._voffset_to_nbytes(contig.ref_beg_voffset)
+            if contig_nbytes > 0 and contig.window_voffsets:
+                ref_len = self.samfile.lengths[tid]
+                nbytes = self._approx_nbytes_at(contig, end_pos, ref_len) - self._approx_nbytes_at(contig, beg_pos, ref_len)
+                return min(contig.n_mapped, max(0, int(round(nbytes * contig.n_mapped / contig_nbytes))))
+        ref_name = self.samfile.get_reference_name(tid)
+        ref_len = self.samfile.get_reference_length(ref_name)
+        n_mapped = self.mapped_per_contig.get(ref_name, 0)
+        return int(round(n_mapped * max(0, min(end_pos, ref_len) - beg_pos) / max(ref_len, 1)))
+
+def estimate_bedlines_n_reads(
+    samfile: pysam.AlignmentFile,
+    bedlines: List[BedLine],
+    exact: bool = False
+) -> List[BedLine]:
+    """Return a copy of the BED regions with n_reads filled from the index (or by counting if exact), or -1 if unknown."""
+    estimator = BamIndexReadCountEstimator(samfile)
+    return [bedline._replace(n_reads=estimator.estimate(bedline.tid, bedline.beg_pos, bedline.end_pos, exact))
+            for bedline in bedlines]
+
+def infer_avg_sequencing_DP(bedlines: List[BedLine], central_readlen: int) -> float:
+    """
+    Infer the average sequencing depth over the BED regions, as needed by bed_in_avg_sequencing_DP = -1.
+
+    Return -1 (still unknown) if the read count of any region is unknown.
+    """
+    if any(bedline.n_reads < 0 for bedline in bedlines):
+        return -1.0
+    tot_len = sum(bedline.end_pos - bedline.beg_pos for bedline in bedlines)
+    tot_n_reads = sum(bedline.n_reads for bedline in bedlines)
+    return (tot_n_reads * central_readlen / tot_len) if tot_len > 0 else 0.0
+
+class AlignmentFilePool:
+    """
+    Per-process cache of opened alignment files and their indexes.
+
+    Each BAM/CRAM is opened and its index is loaded only once per worker process, then the handle
+    is reused for every region that the process is assigned. The handles must not be shared across
+    processes, see get_alignment_file_pool.
+    """
+    def __init__(self, n_threads: int = 1, ref_cache_dir: str = ""):
+        self.n_threads = n_threads
+        self.ref_cache_dir = ref_cache_dir
+        self.samfiles = {}
+        self.estimators = {}
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get(self, fname: str, reference_fname: str = "") -> pysam.AlignmentFile:
+        key = (fname, reference_fname)
+        samfile = self.samfiles.get(key)
+        if samfile is not None:
+            self.n_hits += 1
+            return samfile
+        self.n_misses += 1
+        samfile = open_alignment_file(fname, reference_fname, self.n_threads, self.ref_cache_dir)
+        samfile.check_index()
+        self.samfiles[key] = samfile
+        return samfile
+
+    def get_read_count_estimator(self, fname: str, reference_fname: str = "") -> BamIndexReadCountEstimator:
+        key = (fname, reference_fname)
+        estimator = self.estimators.get(key)
+        if estimator is None:
+            estimator = BamIndexReadCountEstimator(self.get(fname, reference_fname))
+            self.estimators[key] = estimator
+        return estimator
+
+    def close_all(self) -> None:
+        for samfile in self.samfiles.values():
+            samfile.close()
+        self.samfiles = {}
+        self.estimators = {}
+
+    def __str__(self) -> str:
+        return f"AlignmentFilePool(n_open={len(self.samfiles)}, n_hits={self.n_hits}, n_misses={self.n_misses})"
+
+_ALIGNMENT_FILE_POOL = None
+_ALIGNMENT_FILE_POOL_PID = -1
+_ALIGNMENT_FILE_POOL_N_THREADS = 1
+_ALIGNMENT_FILE_POOL_REF_CACHE_DIR = ""
+
+def init_alignment_file_pool(max_cpu_num: int, n_processes: int = 1, ref_cache_dir: str = "") -> AlignmentFilePool:
+    """
+    Configure and reset the pool of the current process, for example as the initializer of a worker process.
+
+    Each opened file gets decompression_thread_num(max_cpu_num, n_processes) htslib threads, and
+    CRAM files are decoded with the local MD5 reference cache in ref_cache_dir. The configuration
+    is inherited by the pools of processes forked afterwards.
+    """
+    global _ALIGNMENT_FILE_POOL, _ALIGNMENT_FILE_POOL_PID, _ALIGNMENT_FILE_POOL_N_THREADS, _ALIGNMENT_FILE_POOL_REF_CACHE_DIR
+    _ALIGNMENT_FILE_POOL_N_THREADS = decompression_thread_num(max_cpu_num, n_processes)
+    _ALIGNMENT_FILE_POOL_REF_CACHE_DIR = ref_cache_dir
+    if _ALIGNMENT_FILE_POOL is not None and _ALIGNMENT_FILE_POOL_PID == os.getpid():
+        _ALIGNMENT_FILE_POOL.close_all()
+    _ALIGNMENT_FILE_POOL = None
+    return get_alignment_file_pool()
+
+def get_alignment_file_pool() -> AlignmentFilePool:
+    """Return the pool of the current process, creating a fresh one in each new (for example forked) worker."""
+    global _ALIGNMENT_FILE_POOL, _ALIGNMENT_FILE_POOL_PID
+    if _ALIGNMENT_FILE_POOL is None or _ALIGNMENT_FILE_POOL_PID != os.getpid():
+        _ALIGNMENT_FILE_POOL = AlignmentFilePool(_ALIGNMENT_FILE_POOL_N_THREADS, _ALIGNMENT_FILE_POOL_REF_CACHE_DIR)
+        _ALIGNMENT_FILE_POOL_PID = os.getpid()
+    return _ALIGNMENT_FILE_POOL
+
+def stream_bam_records_by_fname(
+    bam_fname: str,
+    query_tid: int,
+    query_beg: int,
+    query_end: int,
+    reference_fname: str = ""
+) -> BamRecordStream:
+    return BamRecordStream(get_alignment_file_pool().get(bam_fname, reference_fname), query_tid, query_beg, query_end)
+
+class ReadBatch:
+    """
+    Struct-of-arrays view of a batch of reads.
+
+    Read i has its scalar fields at index i of the per-read arrays, its CIGAR operations in
+    cigar_ops[cigar_offsets[i]:cigar_offsets[i + 1]] (with lengths in cigar_lens), and its query
+    bases and base qualities in seq[seq_offsets[i]:seq_offsets[i + 1]] and qual at the same
+    positions. Bases are kept as their ASCII codes and missing base qualities as 0xFF.
+    """
+    def __init__(self, n_reads: int = 0):
+        self.tid = np.zeros(n_reads, dtype=np.int32)
+        self.ref_start = np.zeros(n_reads, dtype=np.int64)
+        self.ref_end = np.zeros(n_reads, dtype=np.int64)
+        self.flag = np.zeros(n_reads, dtype=np.uint16)
+        self.mapq = np.zeros(n_reads, dtype=np.uint8)
+        self.tlen = np.zeros(n_reads, dtype=np.int64)
+        self.is_reverse = np.zeros(n_reads, dtype=bool)
+        self.cigar_offsets = np.zeros(n_reads + 1, dtype=np.int64)
+        self.cigar_ops = np.zeros(0, dtype=np.uint8)
+        self.cigar_lens = np.zeros(0, dtype=np.uint32)
+        self.seq_offsets = np.zeros(n_reads + 1, dtype=np.int64)
+        self.seq = np.zeros(0, dtype=np.uint8)
+        self.qual = np.zeros(0, dtype=np.uint8)
+        self.qnames: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ref_start)
+
+    def aln_len(self) -> np.ndarray:
+        return self.ref_end - self.ref_start
+
+    def isize(self) -> np.ndarray:
+        return np.abs(self.tlen)
+
+    def query_len(self) -> np.ndarray:
+        return np.diff(self.seq_offsets)
+
+    def seq_of(self, i: int) -> str:
+        return self.seq[self.seq_offsets[i]:self.seq_offsets[i + 1]].tobytes().decode()
+
+    def qual_of(self, i: int) -> np.ndarray:
+        return self.qual[self.seq_offsets[i]:self.seq_offsets[i + 1]]
+
+    def cigartuples_of(self, i: int) -> List[Tuple[int, int]]:
+        beg, end = self.cigar_offsets[i], self.cigar_offsets[i + 1]
+        return list(zip(self.cigar_ops[beg:end].tolist(), self.cigar_lens[beg:end].tolist()))
+
+    def depth(self, beg_pos: int, end_pos: int) -> np.ndarray:
+        """Number of reads spanning each position in [beg_pos, end_pos), computed with a difference array."""
+        diff = np.zeros(end_pos - beg_pos + 1, dtype=np.int64)
+        np.add.at(diff, np.clip(self.ref_start, beg_pos, end_pos) - beg_pos, 1)
+        np.add.at(diff, np.clip(self.ref_end, beg_pos, end_pos) - beg_pos, -1)
+        return np.cumsum(diff[:-1])
+
+KEPT_ALN_FILTER_NAMES = ["discarded_flag", "min_aln_len", "min_mapqual", "min_isize", "max_isize", "zero_isize"]
+
+class AlnFilterStats:
+    """
+    Counts of the reads removed by each kept_aln_* filter.
+
+    A read failing several filters is counted only by the first one in KEPT_ALN_FILTER_NAMES.
+    time_saved is the estimated time that extracting the bases and qualities of the removed reads
+    would have taken.
+    """
+    def __init__(self):
+        self.n_input_reads = 0
+        self.n_removed = {name: 0 for name in KEPT_ALN_FILTER_NAMES}
+        self.filter_time = 0.0
+        self.time_saved = 0.0
+
+    def n_kept_reads(self) -> int:
+        return self.n_input_reads - sum(self.n_removed.values())
+
+    def __str__(self) -> str:
+        removed = " ".join(f"{name}={n}" for name, n in self.n_removed.items())
+        return (f"AlnFilterStats(n_input_reads={self.n_input_reads} n_kept_reads={self.n_kept_reads()} {removed} "
+                f"filter_time={self.filter_time:.6f} time_saved={self.time_saved:.6f})")
+
+def kept_aln_mask(
+    flag: np.ndarray,
+    mapq: np.ndarray,
+    tlen: np.ndarray,
+    aln_len: np.ndarray,
+    args,
+    filter_stats: AlnFilterStats = None
+) -> np.ndarray:
+    """
+    Apply the kept_aln_* parameters of the command-line args to per-read arrays.
+
+    :return: A boolean mask that is True for the reads that are kept.
+    """
+    isize = np.abs(tlen)
+    fail_masks = [
+        (flag & args.kept_aln_discarded_flag) != 0,
+        aln_len < args.kept_aln_min_aln_len,
+        mapq < args.kept_aln_min_mapqual,
+        (isize != 0) & (isize < args.kept_aln_min_isize),
+        isize > args.kept_aln_max_isize,
+        (isize == 0) & bool(args.kept_aln_is_zero_isize_discarded),
+    ]
+    kept = np.ones(len(flag), dtype=bool)
+    for name, fail_mask in zip(KEPT_ALN_FILTER_NAMES, fail_masks):
+        if filter_stats is not None:
+            filter_stats.n_removed[name] += int(np.count_nonzero(kept & fail_mask))
+        kept &= ~fail_mask
+    if filter_stats is not None:
+        filter_stats.n_input_reads += len(flag)
+    return kept
+
+def extract_read_batch(
+    alns: List[pysam.AlignedSegment],
+    is_qname_kept: bool = False,
+    args = None,
+    filter_stats: AlnFilterStats = None
+) -> ReadBatch:
+    """
+    Convert reads into a ReadBatch, touching each pysam.AlignedSegment attribute only once.
+
+    If args is provided, the kept_aln_* filters are applied to the scalar fields first, so that
+    the CIGAR, bases and qualities are only extracted for the reads that are kept.
+    """
+    n_reads = len(alns)
+    ref_starts = [0] * n_reads
+    ref_ends = [0] * n_reads
+    flags = [0] * n_reads
+    mapqs = [0] * n_reads
+    tlens = [0] * n_reads
+    for i, aln in enumerate(alns):
+        ref_start = aln.reference_start
+        ref_end = aln.reference_end
+        ref_starts[i] = ref_start
+        ref_ends[i] = ref_end if ref_end is not None else ref_start
+        flags[i] = aln.flag
+        mapqs[i] = aln.mapping_quality
+        tlens[i] = aln.template_length
+    ref_start_arr = np.array(ref_starts, dtype=np.int64)
+    ref_end_arr = np.array(ref_ends, dtype=np.int64)
+    flag_arr = np.array(flags, dtype=np.uint16)
+    mapq_arr = np.array(mapqs, dtype=np.uint8)
+    tlen_arr = np.array(tlens, dtype=np.int64)
+
+    if args is not None:
+        filter_beg_time = time.perf_counter()
+        kept = kept_aln_mask(flag_arr, mapq_arr, tlen_arr, ref_end_arr - ref_start_arr, args, filter_stats)
+        kept_idxs = np.flatnonzero(kept)
+        if filter_stats is not None:
+            filter_stats.filter_time += time.perf_counter() - filter_beg_time
+        alns = [alns[i] for i in kept_idxs.tolist()]
+        ref_start_arr, ref_end_arr, flag_arr, mapq_arr, tlen_arr = (
+            ref_start_arr[kept], ref_end_arr[kept], flag_arr[kept], mapq_arr[kept], tlen_arr[kept])
+
+    extract_beg_time = time.perf_counter()
+    n_kept_reads = len(alns)
+    batch = ReadBatch(n_kept_reads)
+    tids = [0] * n_kept_reads
+    cigar_offsets = [0] * (n_kept_reads + 1)
+    seq_offsets = [0] * (n_kept_reads + 1)
+    cigar_ops = []
+    cigar_lens = []
+    seqs = []
+    quals = []
+    for i, aln in enumerate(alns):
+        tids[i] = aln.reference_id
+        cigartuples = aln.cigartuples
+        if cigartuples:
+            for op, oplen in cigartuples:
+                cigar_ops.append(op)
+                cigar_lens.append(oplen)
+        cigar_offsets[i + 1] = len(cigar_ops)
+        seq = aln.query_sequence
+        seq = seq.encode() if seq else b""
+        qual = aln.query_qualities
+        seqs.append(seq)
+        quals.append(bytes(qual) if qual is not None else b"\xff" * len(seq))
+        seq_offsets[i + 1] = seq_offsets[i] + len(seq)
+        if is_qname_kept:
+            batch.qnames.append(aln.query_name)
+    batch.tid = np.array(tids, dtype=np.int32)
+    batch.ref_start = ref_start_arr
+    batch.ref_end = ref_end_arr
+    batch.flag = flag_arr
+    batch.mapq = mapq_arr
+    batch.tlen = tlen_arr
+    batch.is_reverse = (batch.flag & 0x10) != 0
+    batch.cigar_offsets = np.array(cigar_offsets, dtype=np.int64)
+    batch.cigar_ops = np.array(cigar_ops, dtype=np.uint8)
+    batch.cigar_lens = np.array(cigar_lens, dtype=np.uint32)
+    batch.seq_offsets = np.array(seq_offsets, dtype=np.int64)
+    batch.seq = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+    batch.qual = np.frombuffer(b"".join(quals), dtype=np.uint8)
+    if args is not None and filter_stats is not None and n_kept_reads > 0:
+        extract_time_per_read = (time.perf_counter() - extract_beg_time) / n_kept_reads
+        filter_stats.time_saved += extract_time_per_read * (n_reads - n_kept_reads)
+    return batch
+
+def iter_read_batches(
+    stream: BamRecordStream,
+    is_qname_kept: bool = False,
+    args = None,
+    filter_stats: AlnFilterStats = None
+) -> Iterator[ReadBatch]:
+    for alns in stream.iter_batches():
+        yield extract_read_batch(alns, is_qname_kept, args, filter_stats)
+
+class PrefetchStats:
+    def __init__(self):
+        self.n_regions = 0
+        self.n_prefetched_regions = 0
+        self.n_over_budget_regions = 0
+        # Over-budget regions found only while decoding (the read count was underestimated or unknown), which are decoded twice.
+        self.n_decoded_over_budget_regions = 0
+        self.consumer_stall_time = 0.0
+        self.producer_block_time = 0.0
+        self.sum_queue_depth = 0
+        self.max_queue_depth = 0
+
+    def avg_queue_depth(self) -> float:
+        return (self.sum_queue_depth / self.n_regions) if self.n_regions > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"PrefetchStats(n_regions={self.n_regions} n_prefetched_regions={self.n_prefetched_regions} "
+                f"n_over_budget_regions={self.n_over_budget_regions} "
+                f"n_decoded_over_budget_regions={self.n_decoded_over_budget_regions} consumer_stall_time={self.consumer_stall_time:.6f} "
+                f"producer_block_time={self.producer_block_time:.6f} avg_queue_depth={self.avg_queue_depth():.3f} "
+                f"max_queue_depth={self.max_queue_depth})")
+
+class PrefetchingRegionLoader:
+    """
+    Iterate over (region, reads) pairs while a background thread decodes the next regions.
+
+    The background thread opens its own handle of the alignment file, because a pysam.AlignmentFile
+    must not be used by two threads at once, and loads up to queue_depth regions ahead of the one
+    being processed. A region exceeding max_prefetch_reads or max_prefetch_nbytes is not kept in
+    memory by the background thread: it is handed over as None and then loaded by the consuming
+    thread with the handle from get_alignment_file_pool. Whether a region exceeds
+    max_prefetch_reads is decided before decoding it, from its n_reads or else from the index
+    estimate, so that deep regions are decoded only once. A region whose read count is unknown or
+    underestimated is found over budget only while decoding, and is then decoded twice.
+
+    consumer_stall_time in the stats is the time the consumer waited for decoding (I/O-bound), and
+    producer_block_time is the time the background thread waited for a free slot (CPU-bound).
+    """
+    _END_OF_REGIONS = object()
+
+    def __init__(
+        self,
+        bam_fname: str,
+        bedlines: List[BedLine],
+        reference_fname: str = "",
+        queue_depth: int = DEFAULT_PREFETCH_QUEUE_DEPTH,
+        max_prefetch_reads: int = DEFAULT_PREFETCH_MAX_READS,
+        max_prefetch_nbytes: int = DEFAULT_PREFETCH_MAX_NBYTES
+    ):
+        self.bam_fname = bam_fname
+        self.bedlines = bedlines
+        self.reference_fname = reference_fname
+        self.max_prefetch_reads = max_prefetch_reads
+        self.max_prefetch_nbytes = max_prefetch_nbytes
+        pool = get_alignment_file_pool()
+        self.n_threads = pool.n_threads
+        self.ref_cache_dir = pool.ref_cache_dir
+        self.stats = PrefetchStats()
+        self._queue = queue.Queue(maxsize=max(1, queue_depth))
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _estimate_n_reads(self) -> List[int]:
+        # Called by the consuming thread, which owns the handle of the pooled estimator.
+        if all(bedline.n_reads >= 0 for bedline in self.bedlines):
+            return [bedline.n_reads for bedline in self.bedlines]
+        estimator = get_alignment_file_pool().get_read_count_estimator(self.bam_fname, self.reference_fname)
+        return [bedline.n_reads if bedline.n_reads >= 0 else estimator.estimate(bedline.tid, bedline.beg_pos, bedline.end_pos)
+                for bedline in self.bedlines]
+
+    def _load_within_budget(self, samfile: pysam.AlignmentFile, bedline: BedLine, n_reads: int):
+        if n_reads > self.max_prefetch_reads:
+            return None
+        alns = []
+        nbytes = 0
+        for aln in BamRecordStream(samfile, bedline.tid, bedline.beg_pos, bedline.end_pos):
+            alns.append(aln)
+            nbytes += 2 * aln.query_length + APPROX_NBYTES_PER_ALN_OVERHEAD
+            if self._stop_event.is_set():
+                return None
+            if len(alns) > self.max_prefetch_reads or nbytes > self.max_prefetch_nbytes:
+                self.stats.n_decoded_over_budget_regions += 1
+                return None
+        return alns
+
+    def _put(self, item) -> bool:
+        beg_time = time.perf_counter()
+        while not self._stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                self.stats.producer_block_time += time.perf_counter() - beg_time
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self, n_reads_per_bedline: List[int]) -> None:
+        try:
+            with open_alignment_file(self.bam_fname, self.reference_fname, self.n_threads, self.ref_cache_dir) as samfile:
+                for bedline, n_reads in zip(self.bedlines, n_reads_per_bedline):
+                    if not self._put((bedline, self._load_within_budget(samfile, bedline, n_reads))):
+                        return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._END_OF_REGIONS)
+
+    def __iter__(self) -> Iterator[Tuple[BedLine, List[pysam.AlignedSegment]]]:
+        self._thread = threading.Thread(target=self._produce, args=(self._estimate_n_reads(),), daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                queue_depth = self._queue.qsize()
+                beg_time = time.perf_counter()
+                item = self._queue.get()
+                self.stats.consumer_stall_time += time.perf_counter() - beg_time
+                if item is self._END_OF_REGIONS:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                bedline, alns = item
+                self.stats.n_regions += 1
+                self.stats.sum_queue_depth += queue_depth
+                self.stats.max_queue_depth = max(self.stats.max_queue_depth, queue_depth)
+                if alns is None:
+                    self.stats.n_over_budget_regions += 1
+                    samfile = get_alignment_file_pool().get(self.bam_fname, self.reference_fname)
+                    alns = load_bam_records(samfile, bedline.tid, bedline.beg_pos, bedline.end_pos)
+                else:
+                    self.stats.n_prefetched_regions += 1
+                yield bedline, alns
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def bgzf_compress_block(data: bytes, level: int = BGZF_DEFAULT_COMPRESS_LEVEL) -> bytes:
+    """Compress at most BGZF_BLOCK_DATA_SIZE bytes into one BGZF block (a gzip member with the BC extra field)."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+def _bgzf_compress_timed(data: bytes, level: int) -> Tuple[bytes, float]:
+    # CPU time of the compressing thread, which is not inflated when there are more threads than cores.
+    beg_time = time.thread_time()
+    ret = bgzf_compress_block(data, level)
+    return ret, time.thread_time() - beg_time
+
+class BgzfWriterStats:
+    def __init__(self):
+        self.n_blocks = 0
+        self.n_uncompressed_bytes = 0
+        self.n_compressed_bytes = 0
+        self.compress_time = 0.0
+        self.wall_time = 0.0
+
+    def mbps_per_thread(self) -> float:
+        """Uncompressed MB compressed per CPU second of one thread."""
+        return self.n_uncompressed_bytes / 1e6 / self.compress_time if self.compress_time > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (f"BgzfWriterStats(n_blocks={self.n_blocks} n_uncompressed_bytes={self.n_uncompressed_bytes} "
+                f"n_compressed_bytes={self.n_compressed_bytes} compress_time={self.compress_time:.6f} "
+                f"wall_time={self.wall_time:.6f} mbps_per_thread={self.mbps_per_thread():.3f})")
+
+class ParallelBgzfWriter:
+    """
+    Writer of a BGZF file (readable by gzip and by htslib) that compresses blocks on a thread pool.
+
+    Written data is buffered until it fills BGZF_BLOCKS_PER_BATCH blocks per thread. Each block is
+    then compressed by a thread (zlib releases the GIL while compressing), and the compressed blocks
+    are written in their original order. At most two batches are in flight, so memory stays bounded.
+    """
+    def __init__(self, fname: str, n_threads: int = 1, level: int = BGZF_DEFAULT_COMPRESS_LEVEL):
+        self.fname = fname
+        self.n_threads = max(1, n_threads)
+        self.level = level
+        self.file = open(fname, "wb")
+        self.executor = ThreadPoolExecutor(max_workers=self.n_threads) if self.n_threads > 1 else None
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.batch_size = BGZF_BLOCK_DATA_SIZE * BGZF_BLOCKS_PER_BATCH * self.n_threads
+        self.stats = BgzfWriterStats()
+        self._beg_time = time.perf_counter()
+
+    def write(self, data: bytes) -> None:
+        self.buffer += data
+        if len(self.buffer) >= self.batch_size:
+            self._submit(len(self.buffer) // BGZF_BLOCK_DATA_SIZE * BGZF_BLOCK_DATA_SIZE)
+
+    def _submit(self, n_bytes: int) -> None:
+        data = bytes(self.buffer[:n_bytes])
+        del self.buffer[:n_bytes]
+        for beg in range(0, len(data), BGZF_BLOCK_DATA_SIZE):
+            block = data[beg:beg + BGZF_BLOCK_DATA_SIZE]
+            self.stats.n_uncompressed_bytes += len(block)
+            if self.executor is None:
+                self._write_block(*_bgzf_compress_timed(block, self.level))
+            else:
+                self.pending.append(self.executor.submit(_bgzf_compress_timed, block, self.level))
+        while len(self.pending) > 2 * BGZF_BLOCKS_PER_BATCH * self.n_threads:
+            self._write_block(*self.pending.popleft().result())
+
+    def _write_block(self, compressed: bytes, compress_time: float) -> None:
+        self.file.write(compressed)
+        self.stats.n_blocks += 1
+        self.stats.n_compressed_bytes += len(compressed)
+        self.stats.compress_time += compress_time
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        if self.buffer:
+            self._submit(len(self.buffer))
+        while self.pending:
+            self._write_block(*self.pending.popleft().result())
+        self.file.write(BGZF_EOF_BLOCK)
+        self.file.close()
+        self.file = None
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.stats.wall_time = time.perf_counter() - self._beg_time
+
+    def __enter__(self) -> 'ParallelBgzfWriter':
+        return self
 
+    def __exit__(self, *exc_info) -> None:
+        self.close()
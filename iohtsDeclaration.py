@@ -3,7 +3,24 @@
 from commonClasses import *
 import pysam
 from collections import namedtuple
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
+
+DEFAULT_STREAM_BATCH_SIZE = 1024
+
+BAI_MIN_SHIFT = 14
+BAI_DEPTH = 5
+BGZF_MAX_BLOCK_SIZE = 0x10000
+BGZF_TYPICAL_COMPRESSION_RATIO = 3.0
+# Uncompressed bytes per BGZF block, the same as htslib, so that even incompressible data fits in a block.
+BGZF_BLOCK_DATA_SIZE = 0xff00
+BGZF_DEFAULT_COMPRESS_LEVEL = 6
+BGZF_BLOCKS_PER_BATCH = 16
+BGZF_EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+DEFAULT_PREFETCH_QUEUE_DEPTH = 1
+DEFAULT_PREFETCH_MAX_READS = 1000 * 1000
+DEFAULT_PREFETCH_MAX_NBYTES = 256 * 1024 * 1024
+APPROX_NBYTES_PER_ALN_OVERHEAD = 400
 
 BedLine = namedtuple('BedLine', ['tname', 'tid', 'beg_pos', 'end_pos', 'region_flag', 'n_reads'])
 
@@ -46,3 +63,21 @@ def load_bam_records(
     #     print(f"Error fetching BAM records: {e}")
     #     return []
 
+
+def stream_bam_records(
+    samfile: pysam.AlignmentFile,
+    query_tid: int,
+    query_beg: int,
+    query_end: int,
+    batch_size: int = DEFAULT_STREAM_BATCH_SIZE
+) -> Iterator[pysam.AlignedSegment]:
+    """
+    Stream BAM records of a region in coordinate order with bounded memory.
+
+    :param samfile: The opened pysam.AlignmentFile object.
+    :param query_tid: Target ID (chromosome index).
+    :param query_beg: Start position of the query region.
+    :param query_end: End position of the query region.
+    :param batch_size: Maximum number of reads per batch when iterating in batches.
+    :return: An iterable over pysam.AlignedSegment objects that reports peak_resident_reads.
+    """
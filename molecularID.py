@@ -1,23 +1,115 @@
 from commonClasses import uvc1_hash_t, uvc1_refgpos_t, uvc1_flag_t
 from hashDeclaration import hash2hash, strhash
+from molecularIDDeclaration import MolecularBarcode
+from typing import List, Tuple
 
-class MolecularBarcode:
-    def __init__(self):
-        # Initialization as per the previous class declaration
-        self.beg_tidpos_pair = (-1, -1)  # Tuple of uvc1_refgpos_t
-        self.end_tidpos_pair = (-1, -1)  # Tuple of uvc1_refgpos_t
-        self.qnamestring = ""
-        self.umistring = ""
-        self.duplexflag = 0x0  # uvc1_flag_t
-        self.dedup_idflag = 0x0  # uvc1_flag_t
-        self.hashvalue = 0  # uvc1_hash_t
-    
-    def calcHash(self) -> uvc1_hash_t:
-        ret: uvc1_hash_t = 0
-        ret += hash2hash(ret, hash2hash(self.beg_tidpos_pair[0], self.beg_tidpos_pair[1]))
-        ret += hash2hash(ret, hash2hash(self.end_tidpos_pair[0], self.end_tidpos_pair[1]))
-        ret += hash2hash(ret, strhash(self.qnamestring))
-        ret += hash2hash(ret, strhash(self.umistring))
-        ret += hash2hash(ret, self.duplexflag)
-        ret += hash2hash(ret, self.dedup_idflag)
-        return ret
+import numpy as np
+
+def calcHashLegacy(mb: MolecularBarcode) -> uvc1_hash_t:
+    # The previous unbounded hash2hash chain, kept to compare against MolecularBarcode.calcHash.
+    ret: uvc1_hash_t = 0
+    ret += hash2hash(ret, hash2hash(mb.beg_tidpos_pair[0], mb.beg_tidpos_pair[1]))
+    ret += hash2hash(ret, hash2hash(mb.end_tidpos_pair[0], mb.end_tidpos_pair[1]))
+    ret += hash2hash(ret, strhash(mb.qnamestring))
+    ret += hash2hash(ret, strhash(mb.umistring))
+    ret += hash2hash(ret, mb.duplexflag)
+    ret += hash2hash(ret, mb.dedup_idflag)
+    return ret
+
+DEFAULT_DEDUP_IDFLAG = 0x3 | 0x8  # begin position, end position and UMI
+UMI_QNAME_SEP = '#'
+DUPLEX_UMI_SEP = '+'
+
+def get_fragment_tidpos_pairs(aln) -> Tuple[Tuple[uvc1_refgpos_t, uvc1_refgpos_t], Tuple[uvc1_refgpos_t, uvc1_refgpos_t]]:
+    """Return the (tid, pos) of the leftmost and rightmost ends of the sequenced fragment, the same for both reads of a pair."""
+    tlen = aln.template_length
+    ref_start = aln.reference_start
+    ref_end = aln.reference_end if aln.reference_end is not None else ref_start
+    if tlen > 0:
+        return (aln.reference_id, ref_start), (aln.reference_id, ref_start + tlen)
+    if tlen < 0:
+        return (aln.reference_id, ref_end + tlen), (aln.reference_id, ref_end)
+    return (aln.reference_id, ref_start), (aln.reference_id, ref_end)
+
+def get_umi_from_qname(qname: str) -> str:
+    """Return the UMI appended to the query name by extract-barcodes.py, or an empty string if there is none."""
+    sep_pos = qname.rfind(UMI_QNAME_SEP)
+    return qname[sep_pos + 1:] if sep_pos >= 0 else ""
+
+def is_bottom_strand(aln) -> bool:
+    # R1 on the forward strand (and R2 on the reverse strand) sequences the top strand of the molecule.
+    return aln.is_reverse != (aln.is_paired and aln.is_read2)
+
+def molecular_barcode_from_alignment(aln, dedup_idflag: uvc1_flag_t = DEFAULT_DEDUP_IDFLAG) -> MolecularBarcode:
+    mb = MolecularBarcode()
+    mb.beg_tidpos_pair, mb.end_tidpos_pair = get_fragment_tidpos_pairs(aln)
+    mb.qnamestring = aln.query_name
+    mb.umistring = get_umi_from_qname(mb.qnamestring)
+    mb.duplexflag = (0x1 if is_bottom_strand(aln) else 0x0)
+    mb.dedup_idflag = dedup_idflag
+    return mb
+
+UMI_PACKED_MAX_LEN = 32
+_UMI_BASE_TO_2BIT = np.full(256, -1, dtype=np.int16)
+for _code, _base in enumerate("ACGT"):
+    _UMI_BASE_TO_2BIT[ord(_base)] = _code
+
+def _rank_encode(values: list) -> np.ndarray:
+    # Ranks of the values in the order of Python comparison, so that ties and order are kept exactly.
+    if values and isinstance(values[0], str):
+        _, ranks = np.unique(np.array(values, dtype=str), return_inverse=True)
+        return ranks.reshape(-1).astype(np.int64)
+    value_to_rank = {value: rank for rank, value in enumerate(sorted(set(values)))}
+    return np.fromiter((value_to_rank[value] for value in values), dtype=np.int64, count=len(values))
+
+def _encode_ints(values: List[int]) -> np.ndarray:
+    if not values or (min(values) >= -(1 << 63) and max(values) < (1 << 63)):
+        return np.array(values, dtype=np.int64)
+    if min(values) >= 0 and max(values) < (1 << 64):
+        return np.array(values, dtype=np.uint64)
+    return _rank_encode(values)
+
+def _encode_umis(umis: List[str]) -> np.ndarray:
+    """
+    Pack UMIs of the same length (at most UMI_PACKED_MAX_LEN) consisting only of A, C, G and T into
+    2 bits per base, first base in the highest bits. A < C < G < T, so the packed integers sort in
+    the same order as the strings. Other UMIs are rank-encoded.
+    """
+    umilen = len(umis[0]) if umis else 0
+    if 0 < umilen <= UMI_PACKED_MAX_LEN and all(len(umi) == umilen for umi in umis):
+        chars = np.frombuffer("".join(umis).encode("latin-1", errors="replace"), dtype=np.uint8)
+        if len(chars) == umilen * len(umis):
+            codes = _UMI_BASE_TO_2BIT[chars].reshape(len(umis), umilen)
+            if (codes >= 0).all():
+                packed = np.zeros(len(umis), dtype=np.uint64)
+                for i in range(umilen):
+                    packed = (packed << np.uint64(2)) | codes[:, i].astype(np.uint64)
+                return packed
+    return _rank_encode(umis)
+
+def argsort_molecular_barcodes(mbs: List[MolecularBarcode]) -> np.ndarray:
+    """
+    Return the permutation that sorts the barcodes in the order of MolecularBarcode.__lt__.
+
+    Each field compared by __lt__ is encoded into a fixed-width integer array (strings by their rank
+    or by 2-bit packing, hash values wider than 64 bits by their rank), and the arrays are sorted at
+    once with a stable np.lexsort. Equal barcodes keep their input order, the same as sorted().
+    """
+    if not mbs:
+        return np.zeros(0, dtype=np.int64)
+    keys = [
+        _encode_ints([mb.beg_tidpos_pair[0] for mb in mbs]),
+        _encode_ints([mb.beg_tidpos_pair[1] for mb in mbs]),
+        _encode_ints([mb.end_tidpos_pair[0] for mb in mbs]),
+        _encode_ints([mb.end_tidpos_pair[1] for mb in mbs]),
+        _rank_encode([mb.qnamestring for mb in mbs]),
+        _encode_umis([mb.umistring for mb in mbs]),
+        _encode_ints([mb.duplexflag for mb in mbs]),
+        _encode_ints([mb.dedup_idflag for mb in mbs]),
+        _encode_ints([mb.hashvalue for mb in mbs]),
+    ]
+    # np.lexsort sorts by the last key first.
+    return np.lexsort(keys[::-1])
+
+def sort_molecular_barcodes(mbs: List[MolecularBarcode]) -> List[MolecularBarcode]:
+    return [mbs[idx] for idx in argsort_molecular_barcodes(mbs)]
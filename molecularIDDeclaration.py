@@ -1,8 +1,13 @@
 from commonClasses import uvc1_refgpos_t, uvc1_flag_t, uvc1_hash_t
 from typing import Tuple
 import hashlib
+import struct
 
 class MolecularBarcode:
+    # Slots instead of a per-instance dict, as there is one barcode per read.
+    __slots__ = ("beg_tidpos_pair", "end_tidpos_pair", "qnamestring", "umistring", "duplexflag", "dedup_idflag", "hashvalue",
+                 "_key_hash")
+
     def __init__(self):
         self.beg_tidpos_pair: Tuple[uvc1_refgpos_t, uvc1_refgpos_t] = (-1, -1)
         self.end_tidpos_pair: Tuple[uvc1_refgpos_t, uvc1_refgpos_t] = (-1, -1)
@@ -13,57 +18,68 @@ class MolecularBarcode:
         self.dedup_idflag: uvc1_flag_t = 0x0
 
         self.hashvalue: uvc1_hash_t = 0
+        # Cache of calcHash() for __hash__, kept apart from hashvalue so that hashing never changes the __lt__ order.
+        self._key_hash: uvc1_hash_t = 0
 
-    def createKey(self) -> 'MolecularBarcode':
-        mb = MolecularBarcode()
-
-        mb.beg_tidpos_pair = (-1, -1)
-        mb.end_tidpos_pair = (-1, -1)
-        
+    def createKeyTuple(self) -> Tuple:
+        """Return the fields of createKey() as a tuple without creating a new barcode."""
         if (self.dedup_idflag & 0x3) == 0x3:
-            min2 = min(self.beg_tidpos_pair, self.end_tidpos_pair)
-            max2 = max(self.beg_tidpos_pair, self.end_tidpos_pair)
-            mb.beg_tidpos_pair = min2
-            mb.end_tidpos_pair = max2
+            beg_tidpos_pair = min(self.beg_tidpos_pair, self.end_tidpos_pair)
+            end_tidpos_pair = max(self.beg_tidpos_pair, self.end_tidpos_pair)
         elif (self.dedup_idflag & 0x1) == 0x1:
-            mb.beg_tidpos_pair = self.beg_tidpos_pair
+            beg_tidpos_pair, end_tidpos_pair = self.beg_tidpos_pair, (-1, -1)
         elif (self.dedup_idflag & 0x2) == 0x2:
-            mb.end_tidpos_pair = self.end_tidpos_pair
-
-        if (self.dedup_idflag & 0x4) == 0x4:
-            mb.qnamestring = self.qnamestring
-        else:
-            mb.qnamestring = ""
-        
-        if (self.dedup_idflag & 0x8) == 0x8:
-            mb.umistring = self.umistring
+            beg_tidpos_pair, end_tidpos_pair = (-1, -1), self.end_tidpos_pair
         else:
-            mb.umistring = ""
-        
-        mb.duplexflag = self.duplexflag
-        mb.dedup_idflag = self.dedup_idflag
+            beg_tidpos_pair, end_tidpos_pair = (-1, -1), (-1, -1)
+        return (beg_tidpos_pair,
+                end_tidpos_pair,
+                (self.qnamestring if (self.dedup_idflag & 0x4) == 0x4 else ""),
+                (self.umistring if (self.dedup_idflag & 0x8) == 0x8 else ""),
+                self.duplexflag,
+                self.dedup_idflag)
 
+    def createKey(self) -> 'MolecularBarcode':
+        mb = MolecularBarcode()
+        (mb.beg_tidpos_pair, mb.end_tidpos_pair, mb.qnamestring, mb.umistring,
+         mb.duplexflag, mb.dedup_idflag) = self.createKeyTuple()
+        mb._key_hash = self._key_hash
         return mb
 
     def __lt__(self, that: 'MolecularBarcode') -> bool:
-        return (self.beg_tidpos_pair < that.beg_tidpos_pair or
-                (self.beg_tidpos_pair == that.beg_tidpos_pair and
-                 (self.end_tidpos_pair < that.end_tidpos_pair or
-                  (self.end_tidpos_pair == that.end_tidpos_pair and
-                   (self.qnamestring < that.qnamestring or
-                    (self.qnamestring == that.qnamestring and
-                     (self.umistring < that.umistring or
-                      (self.umistring == that.umistring and
-                       (self.duplexflag < that.duplexflag or
-                        (self.duplexflag == that.duplexflag and
-                         (self.dedup_idflag < that.dedup_idflag or
-                          (self.dedup_idflag == that.dedup_idflag and
-                           self.hashvalue < that.hashvalue))))))))))))
+        return ((self.beg_tidpos_pair, self.end_tidpos_pair, self.qnamestring, self.umistring,
+                 self.duplexflag, self.dedup_idflag, self.hashvalue) <
+                (that.beg_tidpos_pair, that.end_tidpos_pair, that.qnamestring, that.umistring,
+                 that.duplexflag, that.dedup_idflag, that.hashvalue))
 
     def calcHash(self) -> uvc1_hash_t:
-        # Concatenate all attributes into a string and calculate a hash
-        combined_str = (f"{self.beg_tidpos_pair}{self.end_tidpos_pair}{self.qnamestring}"
-                        f"{self.umistring}{self.duplexflag}{self.dedup_idflag}")
-        
-        # Convert the hash to the same type as uvc1_hash_t
-        return uvc1_hash_t(int(hashlib.sha256(combined_str.encode('utf-8')).hexdigest(), 16))
+        """Return the 64-bit hash of the createKey() projection."""
+        beg_tidpos_pair, end_tidpos_pair, qnamestring, umistring, duplexflag, dedup_idflag = self.createKeyTuple()
+        # BLAKE2b runs in C and is truncated to 8 bytes, which is faster than mixing the fields in Python.
+        hasher = hashlib.blake2b(struct.pack("<qqqqqq", beg_tidpos_pair[0], beg_tidpos_pair[1],
+                                             end_tidpos_pair[0], end_tidpos_pair[1], duplexflag, dedup_idflag),
+                                 digest_size=8)
+        hasher.update(qnamestring.encode())
+        hasher.update(b"\0")
+        hasher.update(umistring.encode())
+        return int.from_bytes(hasher.digest(), "little")
+
+    def updateHash(self) -> uvc1_hash_t:
+        self.hashvalue = self.calcHash()
+        return self.hashvalue
+
+    # A barcode is equal to, and hashes as, its createKey() projection, so that it can be used directly
+    # as the key of its family in a dict or a set. The hash is computed once and cached in _key_hash,
+    # so the fields must not be changed after the barcode is used as a key. Equality is on the projection
+    # only, whereas __lt__ orders by all the fields, so equal barcodes may still be ordered by __lt__.
+    def __hash__(self) -> int:
+        if not self._key_hash:
+            self._key_hash = self.calcHash()
+        return self._key_hash
+
+    def __eq__(self, that) -> bool:
+        if not isinstance(that, MolecularBarcode):
+            return NotImplemented
+        if self._key_hash and that._key_hash and self._key_hash != that._key_hash:
+            return False
+        return self.createKeyTuple() == that.createKeyTuple()
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import json
+import os
+
+import numpy as np
+import pysam
+
+PACKED_REF_SUFFIX = ".2bitpack"
+PACKED_REF_INDEX_SUFFIX = ".2bitpack.json"
+PACKED_REF_VERSION = 1
+REF_WINDOW_SIZE = 1 << 16
+DEFAULT_REF_WINDOW_CACHE_SIZE = 256
+
+BASE_TO_2BIT = np.zeros(256, dtype=np.uint8)
+BASE_IS_N = np.ones(256, dtype=np.uint8)
+for _base, _code in (('A', 0), ('C', 1), ('G', 2), ('T', 3)):
+    for _char in (_base, _base.lower()):
+        BASE_TO_2BIT[ord(_char)] = _code
+        BASE_IS_N[ord(_char)] = 0
+TWOBIT_TO_BASE = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+def pack_bases(seq: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack a sequence into 2 bits per base (first base in the highest bits) and a 1-bit-per-base N-mask.
+
+    Any base other than A, C, G and T (in either case) is stored as A with its N-mask bit set.
+    """
+    bases = np.frombuffer(seq, dtype=np.uint8)
+    codes = BASE_TO_2BIT[bases]
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return packed.astype(np.uint8), np.packbits(BASE_IS_N[bases])
+
+def unpack_bases(packed: np.ndarray, nmask: np.ndarray, beg: int, end: int) -> np.ndarray:
+    """Decode the bases in [beg, end) of a packed sequence into an array of upper-case ASCII codes."""
+    if end <= beg:
+        return np.zeros(0, dtype=np.uint8)
+    packed_part = packed[beg // 4:(end + 3) // 4]
+    codes = np.stack([(packed_part >> 6) & 3, (packed_part >> 4) & 3, (packed_part >> 2) & 3, packed_part & 3], axis=1).ravel()
+    ret = TWOBIT_TO_BASE[codes[beg % 4:beg % 4 + end - beg]]
+    is_n = np.unpackbits(nmask[beg // 8:(end + 7) // 8])[beg % 8:beg % 8 + end - beg]
+    ret[is_n.astype(bool)] = ord('N')
+    return ret
+
+def convert_fasta_to_packed(fasta_fname: str, packed_fname: str = "") -> str:
+    """
+    Convert a FASTA file into a 2-bit packed reference file with a JSON index next to it.
+
+    The packed file contains, for each contig, its 2-bit packed bases followed by its N-mask.
+    Both are written to temporary files first, so that concurrent workers never see a partial file.
+
+    :return: The name of the packed reference file.
+    """
+    if not packed_fname:
+        packed_fname = fasta_fname + PACKED_REF_SUFFIX
+    tmp_suffix = f".tmp.{os.getpid()}"
+    contigs = []
+    offset = 0
+    with pysam.FastaFile(fasta_fname) as fasta, open(packed_fname + tmp_suffix, "wb") as packed_file:
+        for name, length in zip(fasta.references, fasta.lengths):
+            packed, nmask = pack_bases(fasta.fetch(name).encode())
+            packed_file.write(packed.tobytes())
+            packed_file.write(nmask.tobytes())
+            contigs.append({"name": name, "length": length, "packed_offset": offset, "nmask_offset": offset + len(packed)})
+            offset += len(packed) + len(nmask)
+    with open(packed_fname + ".json" + tmp_suffix, "w") as index_file:
+        json.dump({"version": PACKED_REF_VERSION, "contigs": contigs}, index_file)
+    os.replace(packed_fname + tmp_suffix, packed_fname)
+    os.replace(packed_fname + ".json" + tmp_suffix, packed_fname + ".json")
+    return packed_fname
+
+class PackedReferenceStore:
+    """
+    Memory-mapped 2-bit packed reference with an LRU cache of decoded windows.
+
+    The packed file is mapped read-only, so all worker processes share the same pages of the OS page cache.
+    Reference slices are decoded per window of REF_WINDOW_SIZE bases and the decoded windows are
+    kept in an LRU cache keyed by (tid, window). A slice within one window is a view of the cached
+    window and is not copied.
+    """
+    def __init__(self, packed_fname: str, window_cache_size: int = DEFAULT_REF_WINDOW_CACHE_SIZE):
+        with open(packed_fname + ".json") as index_file:
+            index = json.load(index_file)
+        if index["version"] != PACKED_REF_VERSION:
+            raise ValueError(f"The packed reference {packed_fname} has version {index['version']} instead of {PACKED_REF_VERSION}")
+        self.packed_fname = packed_fname
+        self.contigs: List[Dict] = index["contigs"]
+        self.name_to_tid = {contig["name"]: tid for tid, contig in enumerate(self.contigs)}
+        self.data = (np.memmap(packed_fname, dtype=np.uint8, mode="r")
+                     if os.path.getsize(packed_fname) > 0 else np.zeros(0, dtype=np.uint8))
+        self.window_cache_size = window_cache_size
+        self.window_cache = OrderedDict()
+        self.n_cache_hits = 0
+        self.n_cache_misses = 0
+
+    def get_tid(self, name: str) -> int:
+        return self.name_to_tid.get(name, -1)
+
+    def get_length(self, tid: int) -> int:
+        return self.contigs[tid]["length"]
+
+    def packed_view(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return zero-copy views of the packed bases and of the N-mask of a contig."""
+        contig = self.contigs[tid]
+        nmask_end = contig["nmask_offset"] + (contig["length"] + 7) // 8
+        return (self.data[contig["packed_offset"]:contig["nmask_offset"]],
+                self.data[contig["nmask_offset"]:nmask_end])
+
+    def get_window(self, tid: int, window: int) -> np.ndarray:
+        key = (tid, window)
+        ret = self.window_cache.get(key)
+        if ret is not None:
+            self.n_cache_hits += 1
+            self.window_cache.move_to_end(key)
+            return ret
+        self.n_cache_misses += 1
+        packed, nmask = self.packed_view(tid)
+        beg = window * REF_WINDOW_SIZE
+        ret = unpack_bases(packed, nmask, beg, min(beg + REF_WINDOW_SIZE, self.get_length(tid)))
+        ret.flags.writeable = False
+        self.window_cache[key] = ret
+        if len(self.window_cache) > self.window_cache_size:
+            self.window_cache.popitem(last=False)
+        return ret
+
+    def fetch_codes(self, tid: int, beg: int, end: int) -> np.ndarray:
+        """Return the upper-case ASCII codes of the reference bases in [beg, end) of contig tid."""
+        beg = max(beg, 0)
+        end = min(end, self.get_length(tid))
+        if end <= beg:
+            return np.zeros(0, dtype=np.uint8)
+        beg_window = beg // REF_WINDOW_SIZE
+        end_window = (end - 1) // REF_WINDOW_SIZE
+        if beg_window == end_window:
+            offset = beg_window * REF_WINDOW_SIZE
+            return self.get_window(tid, beg_window)[beg - offset:end - offset]
+        parts = [self.get_window(tid, window) for window in range(beg_window, end_window + 1)]
+        offset = beg_window * REF_WINDOW_SIZE
+        return np.concatenate(parts)[beg - offset:end - offset]
+
+    def fetch(self, tid: int, beg: int, end: int) -> str:
+        return self.fetch_codes(tid, beg, end).tobytes().decode()
+
+    def __str__(self) -> str:
+        return (f"PackedReferenceStore({self.packed_fname}, n_contigs={len(self.contigs)}, "
+                f"n_cache_hits={self.n_cache_hits}, n_cache_misses={self.n_cache_misses})")
+
+def open_packed_reference(fasta_fname: str, window_cache_size: int = DEFAULT_REF_WINDOW_CACHE_SIZE) -> PackedReferenceStore:
+    """Open the packed reference of a FASTA file, converting the FASTA first if it is missing or older than the FASTA."""
+    packed_fname = fasta_fname + PACKED_REF_SUFFIX
+    if (not os.path.exists(packed_fname) or not os.path.exists(fasta_fname + PACKED_REF_INDEX_SUFFIX)
+            or os.path.getmtime(packed_fname) < os.path.getmtime(fasta_fname)):
+        convert_fasta_to_packed(fasta_fname, packed_fname)
+    return PackedReferenceStore(packed_fname, window_cache_size)
@@ -0,0 +1,122 @@
+from commonClasses import NUM_WORKING_UNITS_PER_THREAD
+from iohts import init_alignment_file_pool
+from iohtsDeclaration import BedLine
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, List
+import heapq
+import sys
+import time
+
+WorkUnit = namedtuple('WorkUnit', ['unit_id', 'bedlines', 'est_cost'])
+WorkUnitResult = namedtuple('WorkUnitResult', ['unit_id', 'n_regions', 'est_cost', 'wall_time', 'result'])
+
+def is_read_count_known(bedlines: List[BedLine]) -> bool:
+    return len(bedlines) > 0 and all(bedline.n_reads >= 0 for bedline in bedlines) and sum(bedline.n_reads for bedline in bedlines) > 0
+
+def bedline_cost(bedline: BedLine, use_n_reads: bool) -> int:
+    # The +1 keeps empty regions from being free, as each region still costs one fetch.
+    return (bedline.n_reads + 1) if use_n_reads else max(bedline.end_pos - bedline.beg_pos, 1)
+
+def split_bedline(bedline: BedLine, n_pieces: int) -> List[BedLine]:
+    """
+    Split a region into n_pieces adjacent regions of equal length, spreading n_reads evenly over them.
+    """
+    region_len = bedline.end_pos - bedline.beg_pos
+    n_pieces = max(1, min(n_pieces, region_len))
+    ret = []
+    for i in range(n_pieces):
+        beg_pos = bedline.beg_pos + region_len * i // n_pieces
+        end_pos = bedline.beg_pos + region_len * (i + 1) // n_pieces
+        n_reads = (bedline.n_reads * (i + 1) // n_pieces - bedline.n_reads * i // n_pieces) if bedline.n_reads >= 0 else bedline.n_reads
+        ret.append(bedline._replace(beg_pos=beg_pos, end_pos=end_pos, n_reads=n_reads))
+    return ret
+
+def make_work_units(bedlines: List[BedLine], max_cpu_num: int) -> List[WorkUnit]:
+    """
+    Split and pack regions into NUM_WORKING_UNITS_PER_THREAD * max_cpu_num work units of roughly equal cost.
+
+    The cost of a region is its n_reads if every region has a known read count, otherwise its length.
+    Regions more expensive than one unit are split, and the pieces are then packed with the
+    longest-processing-time-first rule, which assigns each piece to the currently cheapest unit.
+    """
+    if not bedlines:
+        return []
+    n_units = NUM_WORKING_UNITS_PER_THREAD * max(1, max_cpu_num)
+    use_n_reads = is_read_count_known(bedlines)
+    tot_cost = sum(bedline_cost(bedline, use_n_reads) for bedline in bedlines)
+    max_unit_cost = max(1, (tot_cost + n_units - 1) // n_units)
+
+    pieces = []
+    for bedline in bedlines:
+        cost = bedline_cost(bedline, use_n_reads)
+        n_pieces = (cost + max_unit_cost - 1) // max_unit_cost
+        pieces.extend(split_bedline(bedline, n_pieces) if n_pieces > 1 else [bedline])
+    pieces.sort(key=lambda piece: bedline_cost(piece, use_n_reads), reverse=True)
+
+    n_units = min(n_units, len(pieces))
+    unit_heap = [(0, unit_id) for unit_id in range(n_units)]
+    unit_bedlines = [[] for _ in range(n_units)]
+    unit_costs = [0] * n_units
+    for piece in pieces:
+        cost, unit_id = heapq.heappop(unit_heap)
+        unit_bedlines[unit_id].append(piece)
+        unit_costs[unit_id] = cost + bedline_cost(piece, use_n_reads)
+        heapq.heappush(unit_heap, (unit_costs[unit_id], unit_id))
+
+    # Within a unit, visit the regions in genomic order so that reads are fetched sequentially.
+    return [WorkUnit(unit_id, sorted(unit_bedlines[unit_id], key=lambda b: (b.tid, b.beg_pos)), unit_costs[unit_id])
+            for unit_id in range(n_units)]
+
+def run_work_unit(worker_fn: Callable[[List[BedLine]], Any], work_unit: WorkUnit) -> WorkUnitResult:
+    beg_time = time.perf_counter()
+    result = worker_fn(work_unit.bedlines)
+    wall_time = time.perf_counter() - beg_time
+    return WorkUnitResult(work_unit.unit_id, len(work_unit.bedlines), work_unit.est_cost, wall_time, result)
+
+def run_work_units(
+    work_units: List[WorkUnit],
+    worker_fn: Callable[[List[BedLine]], Any],
+    max_cpu_num: int,
+    ref_cache_dir: str = ""
+) -> List[WorkUnitResult]:
+    """
+    Run worker_fn on the regions of each work unit with a pool of max_cpu_num processes.
+
+    worker_fn must be a module-level function so that it can be sent to the worker processes.
+    The alignment-file pool of each worker is set up with init_alignment_file_pool, so that the
+    worker processes together use max_cpu_num htslib threads and ref_cache_dir for CRAM.
+    The most expensive units are submitted first. The results are returned in unit_id order.
+    """
+    ordered_units = sorted(work_units, key=lambda work_unit: work_unit.est_cost, reverse=True)
+    if max_cpu_num <= 1:
+        init_alignment_file_pool(max_cpu_num, 1, ref_cache_dir)
+        results = [run_work_unit(worker_fn, work_unit) for work_unit in ordered_units]
+    else:
+        with ProcessPoolExecutor(max_workers=max_cpu_num, initializer=init_alignment_file_pool,
+                                 initargs=(max_cpu_num, max_cpu_num, ref_cache_dir)) as executor:
+            futures = [executor.submit(run_work_unit, worker_fn, work_unit) for work_unit in ordered_units]
+            results = [future.result() for future in futures]
+    return sorted(results, key=lambda result: result.unit_id)
+
+def schedule_regions(
+    bedlines: List[BedLine],
+    worker_fn: Callable[[List[BedLine]], Any],
+    max_cpu_num: int,
+    ref_cache_dir: str = ""
+) -> List[WorkUnitResult]:
+    return run_work_units(make_work_units(bedlines, max_cpu_num), worker_fn, max_cpu_num, ref_cache_dir)
+
+def format_load_balance(results: List[WorkUnitResult]) -> str:
+    lines = ["unit_id\tn_regions\test_cost\twall_time"]
+    for result in results:
+        lines.append(f"{result.unit_id}\t{result.n_regions}\t{result.est_cost}\t{result.wall_time:.3f}")
+    if results:
+        wall_times = [result.wall_time for result in results]
+        mean_wall_time = sum(wall_times) / len(wall_times)
+        lines.append(f"# n_units={len(results)} max_wall_time={max(wall_times):.3f} mean_wall_time={mean_wall_time:.3f} "
+                     f"max_to_mean_ratio={(max(wall_times) / mean_wall_time if mean_wall_time > 0 else 1.0):.3f}")
+    return "\n".join(lines)
+
+def print_load_balance(results: List[WorkUnitResult], file=sys.stderr) -> None:
+    print(format_load_balance(results), file=file)
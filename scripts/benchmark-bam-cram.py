@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# Usage: benchmark-bam-cram.py <BAM> <REF> [<CRAM>] [<comma-separated-thread-nums>]
+# Prints the number of reads per second decoded from the BAM and the CRAM for each number of htslib threads.
+# If <CRAM> is not provided or is None, it is generated from <BAM> in a temporary directory.
+import os
+import sys
+import tempfile
+import time
+
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from iohts import open_alignment_file
+
+def decode_all(fname, ref, n_threads, ref_cache_dir):
+    beg_time = time.perf_counter()
+    n_reads = 0
+    with open_alignment_file(fname, ref, n_threads, ref_cache_dir) as samfile:
+        for aln in samfile.fetch(until_eof=True):
+            aln.query_sequence
+            n_reads += 1
+    return n_reads, time.perf_counter() - beg_time
+
+bam = sys.argv[1]
+ref = sys.argv[2]
+cram = (sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != 'None' else '')
+thread_nums = ([int(x) for x in sys.argv[4].split(',')] if len(sys.argv) > 4 else [1, 2, 4, 8])
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    if not cram:
+        cram = os.path.join(tmpdir, 'benchmark.cram')
+        pysam.view('-C', '-T', ref, '-o', cram, bam, catch_stdout=False)
+        pysam.index(cram)
+    ref_cache_dir = os.path.join(tmpdir, 'ref_cache')
+    # The first open populates the reference cache, so that it is not timed.
+    decode_all(cram, ref, 1, ref_cache_dir)
+    print('format\tthreads\tn_reads\tseconds\treads_per_second\treads_per_second_per_thread')
+    for fname, fmt in ((bam, 'BAM'), (cram, 'CRAM')):
+        for n_threads in thread_nums:
+            n_reads, seconds = decode_all(fname, ref, n_threads, ref_cache_dir)
+            speed = n_reads / seconds if seconds > 0 else 0.0
+            print(f'{fmt}\t{n_threads}\t{n_reads}\t{seconds:.3f}\t{speed:.0f}\t{speed / n_threads:.0f}')
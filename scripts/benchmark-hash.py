@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Usage: benchmark-hash.py [<BAM>|None] [<max-num-reads>]
+# Compares the molecular-barcode hash functions on the UMI and position keys of the reads in <BAM>,
+# or on synthetic keys if <BAM> is not provided or is None.
+# The speed is measured both for computing the hashes and for counting the reads per hash in a dict.
+# The UMI of a read is the part of its query name after the last '#', as generated by extract-barcodes.py.
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from hashDeclaration import HASH64_MASK, hash2hash, hash2hash64, hash2hash128, mix64, strhash, strhash64
+from molecularID import calcHashLegacy
+from molecularIDDeclaration import MolecularBarcode
+
+def iter_bam_keys(bam_fname, max_n_reads):
+    import pysam
+    with pysam.AlignmentFile(bam_fname, 'rb') as samfile:
+        for i, aln in enumerate(samfile.fetch(until_eof=True)):
+            if i >= max_n_reads:
+                break
+            if aln.is_unmapped:
+                continue
+            tlen = aln.template_length
+            beg = (aln.reference_start if tlen >= 0 else aln.reference_end + tlen)
+            end = (aln.reference_start + tlen if tlen > 0 else aln.reference_end)
+            qname = aln.query_name
+            umi = (qname.rsplit('#', 1)[1] if '#' in qname else '')
+            yield ((aln.reference_id, beg), (aln.next_reference_id if tlen else aln.reference_id, end), '', umi, int(aln.is_reverse), 0xB)
+
+def iter_synthetic_keys(max_n_reads):
+    random.seed(0)
+    n_molecules = max(1, max_n_reads // 8)
+    molecules = []
+    for _ in range(n_molecules):
+        beg = random.randint(0, 1000 * 1000)
+        umi = ''.join(random.choice('ACGT') for _ in range(12))
+        molecules.append(((0, beg), (0, beg + random.randint(100, 400)), '', umi, random.randint(0, 1), 0xB))
+    for _ in range(max_n_reads):
+        yield random.choice(molecules)
+
+def make_barcode(key):
+    mb = MolecularBarcode()
+    mb.beg_tidpos_pair, mb.end_tidpos_pair, mb.qnamestring, mb.umistring, mb.duplexflag, mb.dedup_idflag = key
+    return mb
+
+def calc_hash_legacy(key):
+    return calcHashLegacy(make_barcode(key))
+
+def calc_hash_sha256(key):
+    # The SHA-256 hash that MolecularBarcode.calcHash used before it was bounded to 64 bits.
+    mb = make_barcode(key)
+    combined_str = (f"{mb.beg_tidpos_pair}{mb.end_tidpos_pair}{mb.qnamestring}"
+                    f"{mb.umistring}{mb.duplexflag}{mb.dedup_idflag}")
+    return int(hashlib.sha256(combined_str.encode('utf-8')).hexdigest(), 16)
+
+def calc_hash_barcode(key):
+    return make_barcode(key).calcHash()
+
+def make_calc_hash_bounded(mix, finalize=None):
+    def calc_hash(key):
+        (beg_tid, beg_pos), (end_tid, end_pos), qnamestring, umistring, duplexflag, dedup_idflag = key
+        ret = 0
+        ret = mix(ret, mix(beg_tid, beg_pos))
+        ret = mix(ret, mix(end_tid, end_pos))
+        ret = mix(ret, strhash64(qnamestring))
+        ret = mix(ret, strhash64(umistring))
+        ret = mix(ret, duplexflag)
+        ret = mix(ret, dedup_idflag)
+        return finalize(ret) if finalize else ret
+    return calc_hash
+
+def calc_hash_legacy_hash2hash_only(key):
+    (beg_tid, beg_pos), (end_tid, end_pos), qnamestring, umistring, duplexflag, dedup_idflag = key
+    ret = 0
+    ret = hash2hash(ret, hash2hash(beg_tid, beg_pos))
+    ret = hash2hash(ret, hash2hash(end_tid, end_pos))
+    ret = hash2hash(ret, strhash(qnamestring))
+    ret = hash2hash(ret, strhash(umistring))
+    ret = hash2hash(ret, duplexflag)
+    ret = hash2hash(ret, dedup_idflag)
+    return ret
+
+bam_fname = (sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] != 'None' else '')
+max_n_reads = (int(sys.argv[2]) if len(sys.argv) > 2 else 200 * 1000)
+keys = list(iter_bam_keys(bam_fname, max_n_reads) if bam_fname else iter_synthetic_keys(max_n_reads))
+n_distinct_keys = len(set(keys))
+
+print('function\tn_keys\tn_distinct_keys\thashes_per_second\tdict_ops_per_second\tmax_bits\tn_colliding_keys\tn_colliding_keys_mod_2^64')
+for name, calc_hash in (
+        ('calcHashLegacy', calc_hash_legacy),
+        ('hash2hash-chain', calc_hash_legacy_hash2hash_only),
+        ('SHA-256', calc_hash_sha256),
+        ('MolecularBarcode.calcHash', calc_hash_barcode),
+        ('hash2hash64-chain', make_calc_hash_bounded(hash2hash64, mix64)),
+        ('hash2hash128-chain', make_calc_hash_bounded(hash2hash128))):
+    beg_time = time.perf_counter()
+    hashes = [calc_hash(key) for key in keys]
+    seconds = time.perf_counter() - beg_time
+    beg_time = time.perf_counter()
+    hash_to_count = {}
+    for h in hashes:
+        hash_to_count[h] = hash_to_count.get(h, 0) + 1
+    dict_seconds = time.perf_counter() - beg_time
+    key_to_hash = dict(zip(keys, hashes))
+    n_colliding = n_distinct_keys - len(set(key_to_hash.values()))
+    n_colliding_64 = n_distinct_keys - len(set(h & HASH64_MASK for h in key_to_hash.values()))
+    max_bits = max((h.bit_length() for h in hashes), default=0)
+    print(f'{name}\t{len(keys)}\t{n_distinct_keys}\t{(len(keys) / seconds if seconds > 0 else 0.0):.0f}\t{(len(keys) / dict_seconds if dict_seconds > 0 else 0.0):.0f}\t{max_bits}\t{n_colliding}\t{n_colliding_64}')
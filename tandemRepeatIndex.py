@@ -0,0 +1,213 @@
+from commonClasses import MAX_STR_N_BASES, RegionalTandemRepeat
+from referenceStore import PackedReferenceStore, unpack_bases
+from typing import List, Tuple
+import json
+import os
+import shutil
+
+import numpy as np
+
+TR_INDEX_SUFFIX = ".tr"
+TR_INDEX_ARRAY_NAMES = ["track_begs", "track_lens", "track_unitlens", "best_starts", "best_tracks", "any_starts", "any_tracks"]
+TR_INDEX_MAX_CONTIG_LEN = np.iinfo(np.int32).max
+BEST_TR_MAX_UNITLEN = 6
+ANY_TR_MAX_UNITLEN = 16
+# Shorter tracks are not indexed, and their positions get the default of a track of length one.
+TR_MIN_N_COPIES = 3
+TR_MIN_TRACKLEN = 4
+TR_INDEX_CHUNK_SIZE = 1 << 22
+TR_MIN_INDELPHRED = 3
+
+_KEY_UNITLEN_SHIFT = 34
+_KEY_SCORE_SHIFT = 40
+_KEY_TRACK_MASK = (1 << _KEY_UNITLEN_SHIFT) - 1
+
+def tandem_repeat_indelphred(tracklen: int, unitlen: int) -> int:
+    """Phred-scaled prior of an indel in a repeat track, which decreases by 3 for each additional copy of the repeat unit."""
+    return max(TR_MIN_INDELPHRED, 40 + 3 - 3 * (tracklen - unitlen) // unitlen)
+
+def find_repeat_tracks(codes: np.ndarray, unitlen: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the maximal tracks that are periodic with period unitlen, have at least TR_MIN_N_COPIES
+    copies of the unit and are at least TR_MIN_TRACKLEN bases long.
+
+    :param codes: Upper-case ASCII codes of the reference bases, where N never matches.
+    :return: The begin positions and the lengths of the tracks, ordered by begin position.
+    """
+    if len(codes) <= unitlen:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    is_eq = (codes[:-unitlen] == codes[unitlen:]) & (codes[unitlen:] != ord('N'))
+    edges = np.diff(np.concatenate(([0], is_eq.view(np.int8), [0])))
+    run_begs = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    is_kept = (run_ends - run_begs + unitlen) >= max(TR_MIN_N_COPIES * unitlen, TR_MIN_TRACKLEN)
+    begs = run_begs[is_kept].astype(np.int64)
+    return begs, (run_ends[is_kept] - begs + unitlen).astype(np.int64)
+
+def _best_track_per_position(
+    chunk_beg: int,
+    chunk_end: int,
+    tracks_per_unitlen: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    scores_per_unitlen: List[np.ndarray]
+) -> np.ndarray:
+    # Each position takes the covering track with the highest score, then with the smallest unit length.
+    best_keys = np.full(chunk_end - chunk_beg, -1, dtype=np.int64)
+    for (begs, lens, track_ids), scores in zip(tracks_per_unitlen, scores_per_unitlen):
+        beg_idx = np.searchsorted(begs + lens, chunk_beg, side="right")
+        end_idx = np.searchsorted(begs, chunk_end, side="left")
+        if beg_idx >= end_idx:
+            continue
+        part_begs = np.maximum(begs[beg_idx:end_idx], chunk_beg)
+        part_ends = np.minimum(begs[beg_idx:end_idx] + lens[beg_idx:end_idx], chunk_end)
+        part_lens = part_ends - part_begs
+        offsets = np.cumsum(part_lens) - part_lens
+        positions = np.repeat(part_begs - chunk_beg, part_lens) + (np.arange(part_lens.sum()) - np.repeat(offsets, part_lens))
+        np.maximum.at(best_keys, positions, np.repeat(scores[beg_idx:end_idx], part_lens))
+    return best_keys
+
+def _segments(track_per_position: np.ndarray, chunk_beg: int, prev_track: int) -> Tuple[np.ndarray, np.ndarray]:
+    is_change = np.empty(len(track_per_position), dtype=bool)
+    is_change[0] = (track_per_position[0] != prev_track)
+    is_change[1:] = track_per_position[1:] != track_per_position[:-1]
+    idxs = np.flatnonzero(is_change)
+    return idxs + chunk_beg, track_per_position[idxs]
+
+def build_contig_tandem_repeats(codes: np.ndarray) -> dict:
+    """
+    Scan one contig and return its tandem-repeat tracks and the per-position segmentation for the best and any repeat.
+
+    The best repeat of a position is the covering track with unit length at most BEST_TR_MAX_UNITLEN
+    that has the most bases after its first unit (capped at MAX_STR_N_BASES). The any-repeat of a
+    position is the longest covering track with unit length at most ANY_TR_MAX_UNITLEN. Ties go to
+    the smaller unit length. The segmentation stores the positions where the selected track changes.
+    """
+    track_begs, track_lens, track_unitlens = [], [], []
+    tracks_per_unitlen = []
+    n_tracks = 0
+    for unitlen in range(1, ANY_TR_MAX_UNITLEN + 1):
+        begs, lens = find_repeat_tracks(codes, unitlen)
+        track_ids = np.arange(n_tracks, n_tracks + len(begs), dtype=np.int64)
+        n_tracks += len(begs)
+        track_begs.append(begs)
+        track_lens.append(lens)
+        track_unitlens.append(np.full(len(begs), unitlen, dtype=np.int64))
+        tracks_per_unitlen.append((begs, lens, track_ids))
+
+    def make_keys(score_fn, max_unitlen):
+        ret = []
+        for unitlen, (begs, lens, track_ids) in enumerate(tracks_per_unitlen, 1):
+            scores = np.minimum(score_fn(lens, unitlen), MAX_STR_N_BASES) if unitlen <= max_unitlen else np.full(len(lens), -1)
+            keys = (scores << _KEY_SCORE_SHIFT) | ((ANY_TR_MAX_UNITLEN - unitlen) << _KEY_UNITLEN_SHIFT) | track_ids
+            ret.append(np.where(scores >= 0, keys, -1))
+        return ret
+
+    best_keys_per_unitlen = make_keys(lambda lens, unitlen: lens - unitlen, BEST_TR_MAX_UNITLEN)
+    any_keys_per_unitlen = make_keys(lambda lens, unitlen: lens, ANY_TR_MAX_UNITLEN)
+    best_starts, best_tracks, any_starts, any_tracks = [], [], [], []
+    prev_best_track, prev_any_track = -2, -2
+    for chunk_beg in range(0, len(codes), TR_INDEX_CHUNK_SIZE):
+        chunk_end = min(chunk_beg + TR_INDEX_CHUNK_SIZE, len(codes))
+        for keys_per_unitlen, starts, tracks, prev_track in (
+                (best_keys_per_unitlen, best_starts, best_tracks, prev_best_track),
+                (any_keys_per_unitlen, any_starts, any_tracks, prev_any_track)):
+            keys = _best_track_per_position(chunk_beg, chunk_end, tracks_per_unitlen, keys_per_unitlen)
+            track_per_position = np.where(keys >= 0, keys & _KEY_TRACK_MASK, -1)
+            seg_starts, seg_tracks = _segments(track_per_position, chunk_beg, prev_track)
+            starts.append(seg_starts)
+            tracks.append(seg_tracks)
+        prev_best_track = best_tracks[-1][-1] if len(best_tracks[-1]) else prev_best_track
+        prev_any_track = any_tracks[-1][-1] if len(any_tracks[-1]) else prev_any_track
+
+    def concat(arrays):
+        return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
+    return {
+        "track_begs": concat(track_begs), "track_lens": concat(track_lens), "track_unitlens": concat(track_unitlens),
+        "best_starts": concat(best_starts), "best_tracks": concat(best_tracks),
+        "any_starts": concat(any_starts), "any_tracks": concat(any_tracks),
+    }
+
+def build_tandem_repeat_index(store: PackedReferenceStore, index_dname: str = "") -> str:
+    """
+    Scan every contig of the packed reference once and save the tandem-repeat index as a directory of int32 npy files.
+
+    Each array is the concatenation of the arrays of all contigs, and offsets.json gives where each
+    contig begins in each array. Track IDs are local to their contig. Positions are narrowed to
+    int32, so a reference with a contig longer than TR_INDEX_MAX_CONTIG_LEN is refused.
+    """
+    for tid in range(len(store.contigs)):
+        if store.get_length(tid) > TR_INDEX_MAX_CONTIG_LEN:
+            raise ValueError(f"contig {tid} is {store.get_length(tid)} bases long, which does not fit in the int32 tandem-repeat index")
+    if not index_dname:
+        index_dname = store.packed_fname + TR_INDEX_SUFFIX
+    arrays = {name: [] for name in TR_INDEX_ARRAY_NAMES}
+    offsets = {name: [0] for name in TR_INDEX_ARRAY_NAMES}
+    for tid in range(len(store.contigs)):
+        packed, nmask = store.packed_view(tid)
+        contig_arrays = build_contig_tandem_repeats(unpack_bases(packed, nmask, 0, store.get_length(tid)))
+        for name in TR_INDEX_ARRAY_NAMES:
+            arrays[name].append(contig_arrays[name].astype(np.int32))
+            offsets[name].append(offsets[name][-1] + len(contig_arrays[name]))
+    tmp_dname = f"{index_dname}.tmp.{os.getpid()}"
+    os.makedirs(tmp_dname, exist_ok=True)
+    for name in TR_INDEX_ARRAY_NAMES:
+        np.save(os.path.join(tmp_dname, f"{name}.npy"),
+                np.concatenate(arrays[name]) if arrays[name] else np.zeros(0, dtype=np.int32))
+    with open(os.path.join(tmp_dname, "offsets.json"), "w") as offsets_file:
+        json.dump({"n_contigs": len(store.contigs), "offsets": offsets}, offsets_file)
+    if os.path.exists(index_dname):
+        shutil.rmtree(index_dname, ignore_errors=True)
+    try:
+        os.rename(tmp_dname, index_dname)
+    except OSError:
+        # Another worker has just built the same index.
+        shutil.rmtree(tmp_dname, ignore_errors=True)
+    return index_dname
+
+class TandemRepeatIndex:
+    """
+    Per-position tandem-repeat lookup in O(log n) by binary search over the saved segmentation.
+
+    The arrays are memory-mapped read-only, so all worker processes share the same pages of the OS page cache.
+    """
+    def __init__(self, index_dname: str):
+        with open(os.path.join(index_dname, "offsets.json")) as offsets_file:
+            index = json.load(offsets_file)
+        arrays = {name: np.load(os.path.join(index_dname, f"{name}.npy"), mmap_mode="r") for name in TR_INDEX_ARRAY_NAMES}
+        self.contigs = [{name: arrays[name][index["offsets"][name][tid]:index["offsets"][name][tid + 1]]
+                         for name in TR_INDEX_ARRAY_NAMES}
+                        for tid in range(index["n_contigs"])]
+
+    @staticmethod
+    def _track_at(starts: np.ndarray, tracks: np.ndarray, pos: int) -> int:
+        # A Python int would make searchsorted convert the whole int32 array to int64 at every call.
+        idx = int(np.searchsorted(starts, starts.dtype.type(pos), side="right")) - 1
+        return int(tracks[idx]) if idx >= 0 else -1
+
+    def get_tandem_repeat(self, tid: int, pos: int) -> RegionalTandemRepeat:
+        """
+        Return the tandem repeats covering pos, where a position without any indexed repeat is its own track of length one.
+        """
+        contig = self.contigs[tid]
+        ret = RegionalTandemRepeat()
+        ret.begpos, ret.tracklen, ret.unitlen = pos, 1, 1
+        ret.anyTR_begpos, ret.anyTR_tracklen, ret.anyTR_unitlen = pos, 1, 1
+        best_track = self._track_at(contig["best_starts"], contig["best_tracks"], pos)
+        if best_track >= 0:
+            ret.begpos = int(contig["track_begs"][best_track])
+            ret.tracklen = int(contig["track_lens"][best_track])
+            ret.unitlen = int(contig["track_unitlens"][best_track])
+            ret.indelphred = tandem_repeat_indelphred(ret.tracklen, ret.unitlen)
+        any_track = self._track_at(contig["any_starts"], contig["any_tracks"], pos)
+        if any_track >= 0:
+            ret.anyTR_begpos = int(contig["track_begs"][any_track])
+            ret.anyTR_tracklen = int(contig["track_lens"][any_track])
+            ret.anyTR_unitlen = int(contig["track_unitlens"][any_track])
+        return ret
+
+def open_tandem_repeat_index(store: PackedReferenceStore) -> TandemRepeatIndex:
+    """Open the tandem-repeat index of the packed reference, building it first if it is missing or outdated."""
+    index_dname = store.packed_fname + TR_INDEX_SUFFIX
+    offsets_fname = os.path.join(index_dname, "offsets.json")
+    if not os.path.exists(offsets_fname) or os.path.getmtime(offsets_fname) < os.path.getmtime(store.packed_fname):
+        build_tandem_repeat_index(store, index_dname)
+    return TandemRepeatIndex(index_dname)
@@ -0,0 +1,104 @@
+from typing import Dict, List, Tuple
+import time
+
+UMI_CLUSTER_MODE_NONE = "none"
+UMI_CLUSTER_MODE_ADJACENCY = "adjacency"
+UMI_CLUSTER_MODE_DIRECTIONAL = "directional"
+UMI_CLUSTER_MODES = [UMI_CLUSTER_MODE_NONE, UMI_CLUSTER_MODE_ADJACENCY, UMI_CLUSTER_MODE_DIRECTIONAL]
+
+def hamming_distance_within(umi1: str, umi2: str, max_dist: int) -> bool:
+    if len(umi1) != len(umi2):
+        return False
+    n_diffs = 0
+    for char1, char2 in zip(umi1, umi2):
+        if char1 != char2:
+            n_diffs += 1
+            if n_diffs > max_dist:
+                return False
+    return True
+
+class UmiNeighborIndex:
+    """
+    Index for finding all UMIs within Hamming distance max_dist of a UMI.
+
+    Each UMI is cut into max_dist + 1 segments. By the pigeonhole principle, two UMIs of the same
+    length within max_dist substitutions share at least one identical segment, so only the UMIs
+    sharing a segment are compared. For random UMIs, the number of comparisons stays close to
+    linear instead of all-pairs.
+    """
+    def __init__(self, umis: List[str], max_dist: int):
+        self.umis = umis
+        self.max_dist = max_dist
+        self.segment_to_idxs: Dict[Tuple[int, int, str], List[int]] = {}
+        for idx, umi in enumerate(umis):
+            for segment_key in self._segment_keys(umi):
+                self.segment_to_idxs.setdefault(segment_key, []).append(idx)
+
+    def _segment_keys(self, umi: str) -> List[Tuple[int, int, str]]:
+        n_segments = self.max_dist + 1
+        umilen = len(umi)
+        return [(umilen, i, umi[umilen * i // n_segments:umilen * (i + 1) // n_segments]) for i in range(n_segments)]
+
+    def neighbors(self, idx: int) -> List[int]:
+        umi = self.umis[idx]
+        candidates = set()
+        for segment_key in self._segment_keys(umi):
+            candidates.update(self.segment_to_idxs.get(segment_key, []))
+        candidates.discard(idx)
+        return [other for other in candidates if hamming_distance_within(umi, self.umis[other], self.max_dist)]
+
+class UmiClusteringStats:
+    def __init__(self):
+        self.n_positions = 0
+        self.n_umis = 0
+        self.n_merged_umis = 0
+        self.clustering_time = 0.0
+
+    def __str__(self) -> str:
+        return (f"UmiClusteringStats(n_positions={self.n_positions} n_umis={self.n_umis} "
+                f"n_merged_umis={self.n_merged_umis} clustering_time={self.clustering_time:.6f})")
+
+def cluster_umis(
+    umi_to_count: Dict[str, int],
+    mode: str = UMI_CLUSTER_MODE_DIRECTIONAL,
+    max_dist: int = 1,
+    stats: UmiClusteringStats = None
+) -> Dict[str, str]:
+    """
+    Cluster the UMIs observed at one position and map each UMI to the UMI representing its cluster.
+
+    The UMIs are visited from the most to the least supported one, and each UMI not yet assigned
+    becomes the representative of a new cluster. In the adjacency mode, the cluster takes its
+    unassigned direct neighbors. In the directional mode, the cluster grows from each member to
+    any unassigned neighbor whose count is at most (2 * member count - 1).
+    """
+    beg_time = time.perf_counter()
+    umis = sorted(umi_to_count, key=lambda umi: (-umi_to_count[umi], umi))
+    ret = {}
+    if mode == UMI_CLUSTER_MODE_NONE or max_dist <= 0 or len(umis) < 2:
+        ret = {umi: umi for umi in umis}
+    else:
+        index = UmiNeighborIndex(umis, max_dist)
+        for idx, umi in enumerate(umis):
+            if umi in ret:
+                continue
+            ret[umi] = umi
+            if mode == UMI_CLUSTER_MODE_ADJACENCY:
+                for neighbor in index.neighbors(idx):
+                    if umis[neighbor] not in ret:
+                        ret[umis[neighbor]] = umi
+                continue
+            members = [idx]
+            while members:
+                member = members.pop()
+                member_count = umi_to_count[umis[member]]
+                for neighbor in index.neighbors(member):
+                    if umis[neighbor] not in ret and member_count >= 2 * umi_to_count[umis[neighbor]] - 1:
+                        ret[umis[neighbor]] = umi
+                        members.append(neighbor)
+    if stats is not None:
+        stats.n_positions += 1
+        stats.n_umis += len(umis)
+        stats.n_merged_umis += sum(1 for umi, representative in ret.items() if umi != representative)
+        stats.clustering_time += time.perf_counter() - beg_time
+    return ret